@@ -1,26 +1,1049 @@
+import time
+_MODULE_START = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, colorchooser, messagebox
 import threading
-import time
-from pynput import keyboard
+import queue
+import argparse
+import sys
 import platform
 import json
 import os
+import re
 import ctypes
+import math
+import mmap
+import struct
+import zlib
+from array import array
+from collections import deque
 from datetime import datetime
+from types import MappingProxyType
+
+# Тяжёлые зависимости грузятся по требованию: pynput — в потоке listener,
+# pystray — в потоке трея, Pillow — при первом спрайте или иконке трея
+pystray = None
+Image = None
+ImageDraw = None
+ImageFont = None
+ImageTk = None
+_optional_lock = threading.Lock()
+_optional_loaded = set()
+
+
+def _load_pystray():
+    """pystray или None, если не установлен"""
+    global pystray
+    with _optional_lock:
+        if 'pystray' not in _optional_loaded:
+            _optional_loaded.add('pystray')
+            try:
+                import pystray as pystray_module
+                pystray = pystray_module
+            except Exception:
+                pystray = None
+    return pystray
+
+
+def _load_pil():
+    """Pillow (ImageTk отдельно — его может не быть); True, если доступен Image"""
+    global Image, ImageDraw, ImageFont, ImageTk
+    with _optional_lock:
+        if 'PIL' not in _optional_loaded:
+            _optional_loaded.add('PIL')
+            try:
+                from PIL import Image as image_module, ImageDraw as draw_module, ImageFont as font_module
+                Image, ImageDraw, ImageFont = image_module, draw_module, font_module
+            except Exception:
+                pass
+            try:
+                from PIL import ImageTk as imagetk_module
+                ImageTk = imagetk_module
+            except Exception:
+                pass
+    return Image is not None
+
+
+_IMPORT_MS = (time.perf_counter() - _MODULE_START) * 1000
+
+
+class ConfigStore:
+    """config.json: копия в памяти, отложенная запись в фоне, атомарная замена файла"""
+
+    def __init__(self, path, data=None, debounce=0.5, on_error=None):
+        self.path = path
+        self.debounce = debounce
+        self.on_error = on_error
+        # Полное содержимое файла, включая неизвестные нам поля (например default_layout)
+        self._data = dict(data) if isinstance(data, dict) else {}
+        # Содержимое файла на диске, каким мы его последний раз прочитали или записали
+        self._disk_data = dict(self._data)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        self._written = None  # текст последней своей записи — чтобы FileWatcher не принял её за чужую
+
+    @staticmethod
+    def read(path):
+        """Прочитать JSON-объект из файла (None, если файла нет или он битый)"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else None
+        except Exception:
+            return None
+
+    def update(self, data):
+        """Смерджить значения и запланировать запись (частые вызовы схлопываются)"""
+        with self._lock:
+            data = dict(data)
+            # Аккуратно мерджим colors
+            if isinstance(self._data.get('colors'), dict) and isinstance(data.get('colors'), dict):
+                colors = dict(self._data['colors'])
+                colors.update(data.pop('colors'))
+                self._data['colors'] = colors
+            self._data.update(data)
+            self._dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._write)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def disk_snapshot(self):
+        """Копия содержимого файла на диске (без ещё не записанных правок)"""
+        with self._lock:
+            return dict(self._disk_data)
+
+    def is_own_write(self, text):
+        """Это тот текст, что мы сами записали последним?"""
+        with self._lock:
+            return text == self._written
+
+    def reload(self, data, keys=()):
+        """Файл изменили извне: принять его содержимое; при несохранённых своих правках — только поля keys"""
+        with self._lock:
+            self._disk_data = dict(data)
+            if self._dirty:
+                self._data.update({k: data[k] for k in keys if k in data})
+            else:
+                self._data = dict(data)
+
+    def flush(self, timeout=2.0):
+        """Записать несохранённое сейчас, ожидая не дольше timeout"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return True
+        writer = threading.Thread(target=self._write, daemon=True)
+        writer.start()
+        writer.join(timeout)
+        return not writer.is_alive()
+
+    def _write(self):
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                text = json.dumps(self._data, ensure_ascii=False, indent=2)
+                self._dirty = False
+                self._written = text
+                written = dict(self._data)
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                with self._lock:
+                    self._disk_data = written
+            except Exception as e:
+                with self._lock:
+                    self._dirty = True
+                if self.on_error:
+                    self.on_error(e)
+
+
+class AsyncLogger:
+    """Лог в фоновом потоке: очередь в памяти, пакетная запись, ротация по размеру"""
+    LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+    BATCH_SIZE = 1000  # столько сообщений пишем, не дожидаясь flush_interval
+
+    def __init__(self, path, level='INFO', max_bytes=1_000_000, backups=2,
+                 flush_interval=1.0, queue_size=10000):
+        self.path = path
+        self.level = self.LEVELS.get(str(level).upper(), 20)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def enabled_for(self, level):
+        """Проверка уровня до форматирования сообщения (для горячих путей)"""
+        return self.LEVELS.get(level, 20) >= self.level
+
+    def log(self, msg, level='INFO'):
+        if self._closed or self.LEVELS.get(level, 20) < self.level:
+            return
+        try:
+            self._queue.put_nowait((time.time(), level, msg))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, msg):
+        self.log(msg, 'DEBUG')
+
+    def flush(self, timeout=1.0):
+        """Дождаться записи всего, что уже в очереди (не дольше timeout)"""
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=1.0):
+        self.flush(timeout)
+        self._closed = True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Копим сообщения flush_interval от первого (или до BATCH_SIZE) и пишем одним открытием файла;
+            # flush() ждёт — тогда пишем сразу
+            deadline = time.monotonic() + self.flush_interval
+            while not isinstance(batch[-1], threading.Event) and len(batch) < self.BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            waiters = []
+            for entry in batch:
+                if isinstance(entry, threading.Event):
+                    waiters.append(entry)
+                    continue
+                ts, level, msg = entry
+                stamp = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+                prefix = "" if level == 'INFO' else f"{level}: "
+                lines.append(f"[{stamp}] {prefix}{msg}\n")
+            if self.dropped:
+                lines.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] WARNING: dropped {self.dropped} log messages\n")
+                self.dropped = 0
+            if lines:
+                self._write(''.join(lines))
+            for waiter in waiters:
+                waiter.set()
+
+    def _write(self, text):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(text) > self.max_bytes:
+                self._rotate()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(text)
+        except Exception:
+            pass
+
+    def _rotate(self):
+        """keyboard_overlay.log -> .log.1 -> .log.2 ..."""
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+class FrameProfiler:
+    """Время фаз кадра: скользящие окна замеров, перцентили и пропущенные кадры"""
+    PHASES = ('layout', 'input', 'fade', 'alpha', 'draw', 'tk_idle', 'frame')
+
+    def __init__(self, window=600, budget_ms=16.0):
+        self.budget_ms = budget_ms
+        self.samples = {phase: deque(maxlen=window) for phase in self.PHASES}
+        self.frames = 0
+        self.missed = 0
+
+    def add(self, phase, ms):
+        self.samples[phase].append(ms)
+
+    def end_frame(self, frame_ms):
+        self.samples['frame'].append(frame_ms)
+        self.frames += 1
+        if frame_ms > self.budget_ms:
+            self.missed += 1
+
+    def reset(self):
+        for samples in self.samples.values():
+            samples.clear()
+        self.frames = 0
+        self.missed = 0
+
+    def stats(self):
+        """{фаза: (p50, p95, p99, max)} в миллисекундах"""
+        result = {}
+        for phase, samples in self.samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            last = len(ordered) - 1
+            result[phase] = (
+                ordered[int(last * 0.50)],
+                ordered[int(last * 0.95)],
+                ordered[int(last * 0.99)],
+                ordered[last],
+            )
+        return result
+
+    def report_lines(self):
+        lines = [f"Кадров: {self.frames}, дольше {self.budget_ms:.0f} мс: {self.missed}"]
+        for phase, (p50, p95, p99, worst) in self.stats().items():
+            lines.append(f"{phase:8} p50={p50:.3f} p95={p95:.3f} p99={p99:.3f} max={worst:.3f} мс")
+        return lines
+
+
+class LatencyTracker:
+    """Задержка от нажатия (время хука клавиатуры) до отрисовки кадра, который его показал"""
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, ms):
+        self.samples.append(ms)
+        self.count += 1
+
+    def reset(self):
+        self.samples.clear()
+        self.count = 0
+
+    def percentiles(self):
+        """(p50, p99, max) в миллисекундах; None, если замеров ещё нет"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return ordered[int(last * 0.50)], ordered[int(last * 0.99)], ordered[last]
+
+    def report_line(self):
+        stats = self.percentiles()
+        if stats is None:
+            return "Задержка нажатие→экран: нет замеров"
+        p50, p99, worst = stats
+        return f"Задержка нажатие→экран: p50={p50:.1f} p99={p99:.1f} max={worst:.1f} мс ({self.count} нажатий)"
+
+
+class FramePacer:
+    """Расписание кадров по абсолютным дедлайнам (perf_counter): период не дрейфует
+    от времени работы кадра, опоздавшие кадры пропускаются, а не копятся"""
+
+    def __init__(self, target_fps=60):
+        self.next_deadline = None  # None — цикл спал, отсчёт начнётся с ближайшего кадра
+        self.frames = 0
+        self.dropped = 0
+        self._stamps = deque(maxlen=120)
+        self.set_fps(target_fps)
+
+    def set_fps(self, target_fps):
+        self.target_fps = max(1.0, min(float(target_fps), 500.0))
+        self.period = 1.0 / self.target_fps
+
+    def begin(self, now):
+        """Начало кадра; после сна расписание отсчитывается от текущего момента"""
+        if self.next_deadline is None:
+            self.next_deadline = now
+        self.frames += 1
+        self._stamps.append(now)
+
+    def end(self, now):
+        """Конец кадра: задержка до следующего дедлайна в мс (с учётом времени работы)"""
+        deadline = self.next_deadline + self.period
+        if deadline <= now:
+            # Опоздали: пропускаем прошедшие дедлайны целиком
+            missed = int((now - deadline) / self.period) + 1
+            self.dropped += missed
+            deadline += missed * self.period
+        self.next_deadline = deadline
+        return max(0, int(round((deadline - now) * 1000)))
+
+    def sleep(self):
+        """Цикл засыпает — следующий кадр начнёт новое расписание"""
+        self.next_deadline = None
+        self._stamps.clear()
+
+    def achieved_fps(self):
+        """Фактическая частота по последним кадрам непрерывной анимации"""
+        if len(self._stamps) < 2:
+            return 0.0
+        span = self._stamps[-1] - self._stamps[0]
+        return (len(self._stamps) - 1) / span if span > 0 else 0.0
+
+    def reset(self):
+        self.frames = 0
+        self.dropped = 0
+        self._stamps.clear()
+
+    def report_line(self):
+        return (f"FPS: {self.achieved_fps():.1f} из {self.target_fps:.0f}, "
+                f"пропущено кадров: {self.dropped} из {self.frames + self.dropped}")
+
+
+class CanvasRenderer:
+    """Примитивы клавиатуры на Tk canvas (элементы создаются один раз и дальше перенастраиваются)"""
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.created = 0  # создано элементов за всё время — для бенчмарка
+
+    def clear(self):
+        self.canvas.delete("all")
+
+    def rect(self, coords, fill='', outline='', width=0):
+        self.created += 1
+        return self.canvas.create_rectangle(coords, fill=fill, outline=outline, width=width, tags="key")
+
+    def rounded_rect(self, points, fill='', outline='', width=0):
+        self.created += 1
+        return self.canvas.create_polygon(points, fill=fill, outline=outline, width=width, smooth=True, tags="key")
+
+    def text(self, pos, text, fill, font, anchor='center'):
+        self.created += 1
+        return self.canvas.create_text(pos, text=text, fill=fill, font=font, anchor=anchor, tags="key")
+
+    def image(self, pos):
+        self.created += 1
+        return self.canvas.create_image(pos, anchor='center', tags="key")
+
+    def glow(self, rect, color, below):
+        """Кольцо свечения вокруг клавиши — под элементом below"""
+        self.created += 1
+        item = self.canvas.create_rectangle(rect, fill='', outline=color, width=1, tags="key")
+        self.canvas.tag_lower(item, below)
+        return item
+
+    def configure(self, item, **options):
+        self.canvas.itemconfigure(item, **options)
+
+    def move(self, item, coords):
+        self.canvas.coords(item, coords)
+
+
+class RecordingRenderer:
+    """Renderer без экрана: элементы живут в словаре, примитивы и перенастройки считаются.
+
+    Нужен для прогона тысяч кадров без Tk (CI, профилирование чистого Python).
+    """
+
+    def __init__(self):
+        self.items = {}  # {id: {'kind': ..., 'options': {...}}}
+        self.counts = {}  # {'rect' | 'rounded_rect' | 'text' | 'image' | 'glow' | 'configure' | 'move': n}
+        self.created = 0
+        self._next_id = 1
+
+    def _create(self, kind, **options):
+        item = self._next_id
+        self._next_id += 1
+        self.items[item] = {'kind': kind, 'options': options}
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.created += 1
+        return item
+
+    def reset_counts(self):
+        """Обнулить счётчики (например, перед замером кадров, чтобы не считать постройку сцены)"""
+        self.counts = {}
+
+    def kinds(self):
+        """Число живых элементов по видам примитивов"""
+        kinds = {}
+        for item in self.items.values():
+            kinds[item['kind']] = kinds.get(item['kind'], 0) + 1
+        return kinds
+
+    def clear(self):
+        self.items.clear()
+
+    def rect(self, coords, fill='', outline='', width=0):
+        return self._create('rect', coords=coords, fill=fill, outline=outline, width=width)
+
+    def rounded_rect(self, points, fill='', outline='', width=0):
+        return self._create('rounded_rect', coords=points, fill=fill, outline=outline, width=width)
+
+    def text(self, pos, text, fill, font, anchor='center'):
+        return self._create('text', coords=pos, text=text, fill=fill, font=font, anchor=anchor)
+
+    def image(self, pos):
+        return self._create('image', coords=pos)
+
+    def glow(self, rect, color, below):
+        return self._create('glow', coords=rect, outline=color, below=below)
+
+    def configure(self, item, **options):
+        self.counts['configure'] = self.counts.get('configure', 0) + 1
+        self.items[item]['options'].update(options)
+
+    def move(self, item, coords):
+        self.counts['move'] = self.counts.get('move', 0) + 1
+        self.items[item]['options']['coords'] = coords
+
+
+class HeadlessRoot:
+    """Замена tk.Tk для работы без экрана: окно ничего не делает, таймеры только запоминаются.
+
+    Кадры в этом режиме вызываются вручную (run_pending или _animate напрямую).
+    """
+
+    def __init__(self, screen_size=(1920, 1080)):
+        self.screen_size = screen_size
+        self._jobs = {}
+        self._next_job = 1
+
+    def after(self, delay_ms, fn=None, *args):
+        job = f"after#{self._next_job}"
+        self._next_job += 1
+        self._jobs[job] = (delay_ms, fn, args)
+        return job
+
+    def after_idle(self, fn, *args):
+        return self.after(0, fn, *args)
+
+    def after_cancel(self, job):
+        self._jobs.pop(job, None)
+
+    def run_pending(self):
+        """Выполнить все запланированные на сейчас вызовы; возвращает их число"""
+        jobs = list(self._jobs.items())
+        self._jobs.clear()
+        for _, (_, fn, args) in jobs:
+            if fn is not None:
+                fn(*args)
+        return len(jobs)
+
+    def winfo_screenwidth(self):
+        return self.screen_size[0]
+
+    def winfo_screenheight(self):
+        return self.screen_size[1]
+
+    def winfo_x(self):
+        return 0
+
+    def winfo_y(self):
+        return 0
+
+    def winfo_id(self):
+        return 0
+
+    def state(self):
+        return 'normal'
+
+    def _noop(self, *args, **kwargs):
+        return None
+
+    title = attributes = configure = geometry = overrideredirect = _noop
+    withdraw = deiconify = lift = update = update_idletasks = destroy = mainloop = _noop
+
+
+class WindowState:
+    """Желаемые атрибуты окна оверлея (альфа, размер, позиция, click-through).
+
+    Изменения копятся и уходят в оконный менеджер не чаще раза за кадр: flush зовёт цикл анимации,
+    а вне его (перетаскивание во сне) — таймер на период кадра pacer. Уходят только те изменения,
+    что действительно отличаются от уже применённых.
+    """
+    ALPHA_STEPS = 100  # альфа квантуется до 0.01 — меньшие шаги глазом не видны
+
+    GWL_EXSTYLE = -20
+    WS_EX_LAYERED = 0x00080000
+    WS_EX_TRANSPARENT = 0x00000020
+
+    def __init__(self, root, pacer):
+        self.root = root
+        self.pacer = pacer
+        self.is_windows = platform.system() == 'Windows'
+        self._desired = {}
+        self._applied = {}
+        self._flush_job = None
+        self._hwnd = None
+        self._exstyle = None
+        self.pushes = 0  # сколько раз реально трогали оконный менеджер
+
+    def set_alpha(self, alpha):
+        if self.is_windows:
+            self._set('alpha', round(alpha * self.ALPHA_STEPS) / self.ALPHA_STEPS)
+
+    def set_geometry(self, width, height, x, y):
+        self._set('size', (int(width), int(height)))
+        self._set('position', (int(x), int(y)))
+
+    def set_position(self, x, y):
+        self._set('position', (int(x), int(y)))
+
+    def set_click_through(self, enabled):
+        if self.is_windows:
+            self._set('click_through', bool(enabled))
+
+    def position(self):
+        """Позиция окна с учётом ещё не применённых изменений"""
+        position = self._desired.get('position') or self._applied.get('position')
+        if position is None:
+            position = (self.root.winfo_x(), self.root.winfo_y())
+        return position
+
+    def _set(self, name, value):
+        if self._applied.get(name) == value:
+            self._desired.pop(name, None)
+            return
+        self._desired[name] = value
+        if self._flush_job is None:
+            # Не after_idle: idle-проход бывает после каждого события мыши, а нужно не чаще кадра
+            self._flush_job = self.root.after(max(1, int(self.pacer.period * 1000)), self.flush)
+
+    def flush(self):
+        """Применить накопленные изменения сейчас"""
+        if self._flush_job is not None:
+            try:
+                self.root.after_cancel(self._flush_job)
+            except Exception:
+                pass
+            self._flush_job = None
+        desired, self._desired = self._desired, {}
+
+        if 'alpha' in desired:
+            self.root.attributes('-alpha', desired['alpha'])
+            self.pushes += 1
+        if 'size' in desired:
+            width, height = desired['size']
+            x, y = desired.get('position') or self.position()
+            self.root.geometry(f"{width}x{height}+{x}+{y}")
+            self.pushes += 1
+        elif 'position' in desired:
+            x, y = desired['position']
+            self.root.geometry(f"+{x}+{y}")
+            self.pushes += 1
+        if 'click_through' in desired:
+            self._push_click_through(desired['click_through'])
+            self.pushes += 1
+        self._applied.update(desired)
+
+    def _push_click_through(self, enabled):
+        """WS_EX_TRANSPARENT: окно пропускает клики мыши (хэндл и стиль читаются один раз)"""
+        user32 = ctypes.windll.user32
+        if self._hwnd is None:
+            self.root.update_idletasks()
+            self._hwnd = user32.GetParent(self.root.winfo_id())
+            self._exstyle = user32.GetWindowLongW(self._hwnd, self.GWL_EXSTYLE)
+
+        style = self._exstyle | self.WS_EX_LAYERED
+        if enabled:
+            style |= self.WS_EX_TRANSPARENT
+        else:
+            style &= ~self.WS_EX_TRANSPARENT
+        if style != self._exstyle or 'click_through' not in self._applied:
+            user32.SetWindowLongW(self._hwnd, self.GWL_EXSTYLE, style)
+            self._exstyle = style
+
+
+class KeyHeatmap:
+    """Частота нажатий по клавишам: экспоненциально затухающие счётчики и нажатия за минуту.
+
+    add() — O(1) на событие; уровни подсветки пересчитываются редко (update_levels).
+    """
+    LEVELS = 8
+
+    def __init__(self, size, window=60.0):
+        self.window = max(1.0, float(window))
+        self.counts = array('d', [0.0]) * size
+        self.stamps = array('d', [0.0]) * size
+        self.levels = array('B', [0]) * size
+        # Кольцо посекундных корзин за последнюю минуту (для KPM/WPM)
+        self._slot_second = array('q', [0]) * 60
+        self._slot_count = array('I', [0]) * 60
+
+    def add(self, key_id, press_time):
+        if key_id is not None:
+            count = self.counts[key_id]
+            if count:
+                count *= math.exp((self.stamps[key_id] - press_time) / self.window)
+            self.counts[key_id] = count + 1.0
+            self.stamps[key_id] = press_time
+        second = int(press_time)
+        slot = second % 60
+        if self._slot_second[slot] != second:
+            self._slot_second[slot] = second
+            self._slot_count[slot] = 0
+        self._slot_count[slot] += 1
+
+    def kpm(self, now):
+        """Нажатий за последние 60 секунд"""
+        second = int(now)
+        total = 0
+        for slot in range(60):
+            if second - 60 < self._slot_second[slot] <= second:
+                total += self._slot_count[slot]
+        return total
+
+    def update_levels(self, now):
+        """Пересчитывает уровни подсветки (0..LEVELS); True, если какой-то изменился"""
+        window = self.window
+        values = [count * math.exp((stamp - now) / window) if count else 0.0
+                  for count, stamp in zip(self.counts, self.stamps)]
+        peak = max(values, default=0.0)
+        changed = False
+        for key_id, value in enumerate(values):
+            level = int(math.ceil(value / peak * self.LEVELS)) if value >= 0.05 else 0
+            if level != self.levels[key_id]:
+                self.levels[key_id] = level
+                changed = True
+        return changed
+
+
+class KeystrokeRecorder:
+    """Запись нажатий в бинарный лог: заголовок и записи фиксированного размера.
+
+    Заголовок: MAGIC, число клавиш, CRC рядов раскладок, имена раскладок — id клавиш и номера
+    раскладок в записях имеют смысл только при тех же layouts.json. Повторный запуск дописывает
+    в тот же файл новый сеанс (с меткой сеанса), но только если заголовок совпадает.
+    """
+    MAGIC = b'KOVLREC2'
+    # число клавиш, CRC32 рядов раскладок, длина имён раскладок (UTF-8 через \n)
+    HEADER = struct.Struct('<HIH')
+    # время (time.monotonic), код символа, id клавиши, раскладка, выравнивание — 16 байт
+    RECORD = struct.Struct('<dIHBx')
+    NO_KEY = 0xFFFF
+    NO_LAYOUT = 0xFF
+    SESSION = 0xFE  # в поле раскладки: дальше записи нового сеанса (его часы не связаны с прошлым)
+
+    def __init__(self, path, layouts, key_count):
+        self.path = path
+        self.layouts = tuple(layouts)
+        self.count = 0
+        header = self.header(layouts, key_count)
+        existing = b''
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                existing = f.read(len(header))
+        if existing and existing != header:
+            raise ValueError(f"{path}: лог записан с другим layouts.json — укажите новый файл")
+        self._file = open(path, 'ab', buffering=64 * 1024)
+        if existing:
+            self._file.write(self.RECORD.pack(0.0, 0, self.NO_KEY, self.SESSION))
+        else:
+            self._file.write(header)
+
+    @classmethod
+    def header(cls, layouts, key_count):
+        """Заголовок лога для раскладок {имя: {'rows': ...}} и числа клавиш"""
+        rows = json.dumps([[name, layout['rows']] for name, layout in layouts.items()], ensure_ascii=False)
+        names = '\n'.join(layouts).encode('utf-8')
+        return cls.MAGIC + cls.HEADER.pack(key_count, zlib.crc32(rows.encode('utf-8')), len(names)) + names
+
+    def write(self, press_time, char, key_id, layout):
+        layout_code = self.layouts.index(layout) if layout in self.layouts else self.NO_LAYOUT
+        self._file.write(self.RECORD.pack(
+            press_time,
+            ord(char[0]) if char else 0,
+            self.NO_KEY if key_id is None else key_id,
+            layout_code
+        ))
+        self.count += 1
+
+    def close(self):
+        try:
+            self._file.close()
+        except Exception:
+            pass
+
+
+class KeystrokeReplay:
+    """Чтение лога KeystrokeRecorder через mmap, без загрузки файла в память"""
+
+    def __init__(self, path, layouts, key_count):
+        self.path = path
+        self.layouts = tuple(layouts)
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        magic = KeystrokeRecorder.MAGIC
+        if self._map is None or self._map[:len(magic)] != magic:
+            self.close()
+            raise ValueError(f"{path}: не лог нажатий Keyboard Overlay (или старый формат)")
+        header = KeystrokeRecorder.header(layouts, key_count)
+        if self._map[:len(header)] != header:
+            self.close()
+            raise ValueError(f"{path}: лог записан с другим layouts.json — клавиши и раскладки не совпадут")
+        # Недописанный хвост (запись оборвалась) отбрасываем
+        record_size = KeystrokeRecorder.RECORD.size
+        self._start = len(header)
+        self._end = self._start + (size - self._start) // record_size * record_size
+        # Метки сеансов — не события; поле раскладки — предпоследний байт записи
+        self._sessions = self._map[self._start + record_size - 2:self._end:record_size].count(
+            bytes([KeystrokeRecorder.SESSION]))
+
+    def __len__(self):
+        return (self._end - self._start) // KeystrokeRecorder.RECORD.size - self._sessions
+
+    def events(self):
+        """(время, символ, id клавиши или None, раскладка или None) по порядку записи.
+
+        Сеансы, дописанные в тот же файл, склеиваются без паузы: время сдвигается к концу прошлого сеанса.
+        """
+        layouts = self.layouts
+        view = memoryview(self._map)[self._start:self._end]
+        offset = 0.0
+        last = None
+        new_session = False
+        try:
+            for press_time, code, key_id, layout_code in KeystrokeRecorder.RECORD.iter_unpack(view):
+                if layout_code == KeystrokeRecorder.SESSION:
+                    new_session = True
+                    continue
+                if new_session and last is not None:
+                    offset = last - press_time
+                new_session = False
+                press_time += offset
+                last = press_time
+                yield (
+                    press_time,
+                    chr(code) if code else '',
+                    None if key_id == KeystrokeRecorder.NO_KEY else key_id,
+                    layouts[layout_code] if layout_code < len(layouts) else None,
+                )
+        finally:
+            view.release()
+
+    def close(self):
+        try:
+            if self._map is not None:
+                self._map.close()
+        except Exception:
+            pass
+        self._file.close()
+
+
+class Win32LayoutBackend:
+    """Язык раскладки активного окна через user32 (библиотека загружается один раз)"""
+    def __init__(self):
+        self.user32 = ctypes.WinDLL('user32', use_last_error=True)
+
+    def language_id(self):
+        hwnd = self.user32.GetForegroundWindow()
+        thread_id = self.user32.GetWindowThreadProcessId(hwnd, 0)
+        return self.user32.GetKeyboardLayout(thread_id) & 0xFFFF
+
+
+class FakeLayoutBackend:
+    """Подменный источник раскладки (Linux, тесты): язык задаётся вручную"""
+    def __init__(self, language_id=0x0409):
+        self.current_language_id = language_id
+
+    def language_id(self):
+        return self.current_language_id
+
+
+class LayoutWatcher:
+    """Фоновый опрос раскладки: уведомляет только при смене, вне кадра и хука клавиатуры"""
+
+    def __init__(self, backend, on_change, poll_interval=0.25, language_layouts=None, default='en'):
+        self.backend = backend
+        self.on_change = on_change
+        self.poll_interval = max(0.02, float(poll_interval))
+        self.default = default
+        # {LANGID: раскладка}; если точного LANGID нет — по основному языку (младшие 10 бит)
+        self.language_layouts = dict(language_layouts or {})
+        self.primary_layouts = {}
+        for language_id, layout in self.language_layouts.items():
+            self.primary_layouts.setdefault(language_id & 0x3FF, layout)
+        self.layout = default
+        self.profiler = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def detect(self):
+        """Текущая раскладка по данным backend (раскладка по умолчанию при любой ошибке)"""
+        try:
+            language_id = self.backend.language_id()
+        except Exception:
+            return self.default
+        layout = self.language_layouts.get(language_id)
+        if layout is None:
+            layout = self.primary_layouts.get(language_id & 0x3FF, self.default)
+        return layout
+
+    def poll(self):
+        """Один опрос: вызывает on_change, если раскладка сменилась"""
+        layout = self.detect()
+        if layout != self.layout:
+            self.layout = layout
+            self.on_change(layout)
+        return layout
+
+    def start(self):
+        self.layout = self.detect()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                profiler = self.profiler
+                if profiler is None:
+                    self.poll()
+                else:
+                    start = time.perf_counter()
+                    self.poll()
+                    profiler.add('layout', (time.perf_counter() - start) * 1000)
+            except Exception:
+                pass
+
+
+class FileWatcher:
+    """Фоновая проверка файлов по (mtime, размер): уведомляет только об изменившихся, кадр не трогает"""
+
+    def __init__(self, paths, on_change, poll_interval=1.0):
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.on_change = on_change
+        self.poll_interval = max(0.1, float(poll_interval))
+        self._signatures = {path: self.signature(path) for path in self.paths}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def signature(path):
+        """(mtime, размер) файла; None, если файла нет"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def poll(self):
+        """Один проход: on_change(path) для каждого изменившегося файла"""
+        changed = []
+        for path in self.paths:
+            sig = self.signature(path)
+            if sig != self._signatures[path]:
+                self._signatures[path] = sig
+                if sig is not None:
+                    changed.append(path)
+                    self.on_change(path)
+        return changed
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                pass
 
-try:
-    import pystray
-    from PIL import Image, ImageDraw, ImageFont
-except Exception:
-    pystray = None
-    Image = None
-    ImageDraw = None
-    ImageFont = None
 
 class KeyboardOverlay:
-    def __init__(self, config_path='config.json'):
-        self.root = tk.Tk()
+    # Шаг квантования альфы для кэша цветов (64 уровня от 0 до 1)
+    ALPHA_LEVELS = 64
+    # Уровни яркости нажатия, для которых заготавливаются спрайты
+    SPRITE_PRESS_LEVELS = 4
+    # Во сколько раз спрайт рисуется крупнее перед сглаживающим уменьшением
+    SPRITE_SUPERSAMPLE = 3
+    # Цвета по умолчанию; темы из themes.json накладываются поверх них
+    DEFAULT_COLORS = MappingProxyType({
+        'bg': '#00000000',
+        'key_bg': '#30202030',
+        'key_border': '#60ffffff',
+        'key_text': '#ffffff',
+        'key_pressed': '#00d4ff',
+        'key_pressed_text': '#000000',
+        'key_pressed_border': '#00ffff',
+        'key_shadow': '#20000000',
+        'key_highlight': '#40ffffff',
+    })
+    COLOR_RE = re.compile(r'^#([0-9a-fA-F]{6}|[0-9a-fA-F]{8})$')
+    # Не больше стольких шагов в рампе плавной смены темы
+    CROSSFADE_MAX_STEPS = 30
+    # Кривые затухания подсветки клавиши; считаются таблицей из EASING_STEPS значений
+    FADE_EASINGS = ('linear', 'ease_out', 'exponential', 'spring')
+    EASING_STEPS = 256
+    # Пока цикл анимации не спит, очередь нажатий проверяется из потока Tk с этим периодом (мс):
+    # задержка немедленной перерисовки ограничена им, а хук клавиатуры не делает вызовов Tk
+    INPUT_POLL_MS = 4
+    # Служебные клавиши — общий для всех раскладок последний ряд:
+    # (имя, подпись, ширина в клавишах, скан-код, коды VK Windows, имена pynput.Key)
+    SPECIAL_KEYS = (
+        ('tab', 'Tab', 1.5, 0x0F, (0x09,), ('tab',)),
+        ('caps', 'Caps', 1.75, 0x3A, (0x14,), ('caps_lock',)),
+        ('shift', 'Shift', 2.25, 0x2A, (0x10, 0xA0, 0xA1), ('shift', 'shift_l', 'shift_r')),
+        ('ctrl', 'Ctrl', 1.5, 0x1D, (0x11, 0xA2, 0xA3), ('ctrl', 'ctrl_l', 'ctrl_r')),
+        ('alt', 'Alt', 1.5, 0x38, (0x12, 0xA4, 0xA5), ('alt', 'alt_l', 'alt_r', 'alt_gr')),
+        ('space', 'Space', 5.0, 0x39, (0x20,), ('space',)),
+        ('enter', 'Enter', 2.25, 0x1C, (0x0D,), ('enter',)),
+        ('backspace', '⌫', 2.0, 0x0E, (0x08,), ('backspace',)),
+    )
+    # Скан-коды (set 1) и коды VK Windows для позиций четырёх рядов символов (как на US-клавиатуре)
+    SCAN_CODES = (
+        (0x29, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D),
+        (0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x1B, 0x2B),
+        (0x1E, 0x1F, 0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28),
+        (0x2C, 0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x32, 0x33, 0x34, 0x35),
+    )
+    VK_CODES = (
+        (0xC0, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x30, 0xBD, 0xBB),
+        (0x51, 0x57, 0x45, 0x52, 0x54, 0x59, 0x55, 0x49, 0x4F, 0x50, 0xDB, 0xDD, 0xDC),
+        (0x41, 0x53, 0x44, 0x46, 0x47, 0x48, 0x4A, 0x4B, 0x4C, 0xBA, 0xDE),
+        (0x5A, 0x58, 0x43, 0x56, 0x42, 0x4E, 0x4D, 0xBC, 0xBE, 0xBF),
+    )
+    # Раскладки на случай, если layouts.json нет или он повреждён
+    BUILTIN_LAYOUTS = {
+        'en': {
+            'name': 'English',
+            'language_ids': [0x0409],
+            'rows': [
+                ['`', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '-', '='],
+                ['q', 'w', 'e', 'r', 't', 'y', 'u', 'i', 'o', 'p', '[', ']', '\\'],
+                ['a', 's', 'd', 'f', 'g', 'h', 'j', 'k', 'l', ';', "'"],
+                ['z', 'x', 'c', 'v', 'b', 'n', 'm', ',', '.', '/'],
+            ],
+        },
+        'ru': {
+            'name': 'Русская',
+            'language_ids': [0x0419],
+            'rows': [
+                ['ё', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '-', '='],
+                ['й', 'ц', 'у', 'к', 'е', 'н', 'г', 'ш', 'щ', 'з', 'х', 'ъ', '\\'],
+                ['ф', 'ы', 'в', 'а', 'п', 'р', 'о', 'л', 'д', 'ж', 'э'],
+                ['я', 'ч', 'с', 'м', 'и', 'т', 'ь', 'б', 'ю', '.'],
+            ],
+        },
+    }
+    
+    def __init__(self, config_path='config.json', start_listener=True, start_tray=True, headless=False):
+        # Профиль запуска: [(фаза, мс)], фоновые фазы дописываются из своих потоков
+        self.startup_phases = [('imports', _IMPORT_MS)]
+        self._startup_mark = time.perf_counter()
+        # headless: без экрана и Tk — окно-заглушка и RecordingRenderer (прогон кадров в CI)
+        self.headless = headless
+        self.root = HeadlessRoot() if headless else tk.Tk()
         self.root.title("Keyboard Overlay")
 
         self.log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keyboard_overlay.log')
@@ -28,6 +1051,18 @@ class KeyboardOverlay:
         # Загрузка конфигурации
         self.config = self._load_config(config_path)
         self.config_path = config_path
+        self.logger = AsyncLogger(
+            self.log_path,
+            level=self.config.get('log_level', 'INFO'),
+            max_bytes=int(self.config.get('log_max_bytes', 1_000_000))
+        )
+        self.config_store = ConfigStore(
+            config_path,
+            ConfigStore.read(config_path),
+            debounce=float(self.config.get('save_debounce', 0.5)),
+            on_error=self._on_config_save_error
+        )
+        self._mark_startup('config')
         
         # Настройки
         self.position = self.config.get('position', 'bottom')
@@ -38,7 +1073,7 @@ class KeyboardOverlay:
         self.height = self.config.get('height', 300)
         self.max_alpha = float(self.config.get('max_alpha', 0.92))
         self.min_alpha = float(self.config.get('min_alpha', 0.30))
-        self.visible_rows = self.config.get('visible_rows', [True, True, True, True])
+        self.visible_rows = self.config.get('visible_rows', [True, True, True, True, False])
         self.disabled_keys = self.config.get('disabled_keys', {})  # {"row_0": ["1", "2"], ...}
         self.tray_icon_path = self.config.get('tray_icon_path', 'tray.ico')
         
@@ -49,25 +1084,32 @@ class KeyboardOverlay:
         self.glow_intensity = self.config.get('glow_intensity', 1.0)
         self.border_width = self.config.get('border_width', 2)
         self.key_padding = self.config.get('key_padding', 6)
+        self.render_backend = self.config.get('render_backend', 'canvas')  # canvas, sprites
+        self.display_mode = self.config.get('display_mode', 'keys')  # keys, heatmap
+        self.heatmap_window = float(self.config.get('heatmap_window', 60.0))
         
-        self.colors = self.config.get('colors', {
-            'bg': '#00000000',
-            'key_bg': '#30202030',
-            'key_border': '#60ffffff',
-            'key_text': '#ffffff',
-            'key_pressed': '#00d4ff',
-            'key_pressed_text': '#000000',
-            'key_pressed_border': '#00ffff',
-            'key_shadow': '#20000000',
-            'key_highlight': '#40ffffff',
-        })
+        self.colors = self.config.get('colors', dict(self.DEFAULT_COLORS))
+        self.theme_crossfade = max(0.0, float(self.config.get('theme_crossfade', 0.4)))
         
-        # Состояние нажатых клавиш
-        self.pressed_keys = {}  # {символ: (время, яркость)}
-        self.last_activity_time = time.time()
+        # Состояние нажатых клавиш — массивы по id клавиши, см. _compile_key_table (только поток Tk)
+        # Нажатия из потока pynput: (monotonic, id клавиши, символ, perf_counter хука); разбираются в потоке Tk
+        self._input_events = queue.SimpleQueue()
+        self.recorder = None  # KeystrokeRecorder при запуске с --record
+        # Время нажатий, затухания и простоя — монотонное (time.monotonic), не зависит от перевода часов
+        self.last_activity_time = time.monotonic()
         self.idle_timeout = self.config.get('idle_timeout', 5.0)
         self.fade_duration = self.config.get('fade_duration', 2.0)
         self.key_fade_duration = self.config.get('key_fade_duration', 0.8)
+        self._set_fade_easing(self.config.get('key_fade_easing', 'linear'))
+        # Нажатие перерисовывается сразу, не дожидаясь очередного кадра; задержка до экрана замеряется
+        self.immediate_redraw = bool(self.config.get('immediate_redraw', True))
+        self.latency = LatencyTracker()
+        self._latency_pending = []  # perf_counter хука для нажатий, ещё не дошедших до экрана
+        self._latency_job = None
+        self._input_poll_job = None
+        # Частота кадров анимации; шаг сглаживания альфы окна пересчитывается под неё
+        self.pacer = FramePacer(self.config.get('target_fps', 60))
+        self._alpha_step = 1 - 0.9 ** (60 / self.pacer.target_fps)
         self.current_alpha = self.max_alpha
         self.target_alpha = self.max_alpha
         
@@ -78,73 +1120,219 @@ class KeyboardOverlay:
         self.window_start_x = 0
         self.window_start_y = 0
         
-        # УПРОЩЕННАЯ система раскладок - показываем английскую, подсвечиваем что нажато
-        self.english_layout = [
-            ['`', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '-', '='],
-            ['q', 'w', 'e', 'r', 't', 'y', 'u', 'i', 'o', 'p', '[', ']', '\\'],
-            ['a', 's', 'd', 'f', 'g', 'h', 'j', 'k', 'l', ';', "'"],
-            ['z', 'x', 'c', 'v', 'b', 'n', 'm', ',', '.', '/'],
-        ]
-        
-        self.russian_layout = [
-            ['ё', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '-', '='],
-            ['й', 'ц', 'у', 'к', 'е', 'н', 'г', 'ш', 'щ', 'з', 'х', 'ъ', '\\'],
-            ['ф', 'ы', 'в', 'а', 'п', 'р', 'о', 'л', 'д', 'ж', 'э'],
-            ['я', 'ч', 'с', 'м', 'и', 'т', 'ь', 'б', 'ю', '.'],
-        ]
+        # Раскладки из layouts.json: {имя: {'name', 'language_ids', 'rows'}}, первая — базовая
+        self.layouts = self._load_layouts('layouts.json')
+        self.default_layout = 'en' if 'en' in self.layouts else next(iter(self.layouts))
+        # Ряды базовой раскладки: по ним отключаются клавиши (disabled_keys) и строятся настройки
+        self.base_layout = self.layouts[self.default_layout]['rows']
+        self.visible_rows = self._pad_visible_rows(self.visible_rows)
         
-        # Маппинг русских букв к английским позициям и обратно
-        self.ru_to_en_map = {}
-        self.en_to_ru_map = {}
-        for row_idx in range(min(len(self.english_layout), len(self.russian_layout))):
-            for col_idx in range(min(len(self.english_layout[row_idx]), len(self.russian_layout[row_idx]))):
-                en_char = self.english_layout[row_idx][col_idx]
-                ru_char = self.russian_layout[row_idx][col_idx]
-                self.ru_to_en_map[ru_char] = en_char
-                self.en_to_ru_map[en_char] = ru_char
+        # id физических клавиш, таблицы символ → id и подписи для каждой раскладки
+        self._compile_key_table()
+        self.heatmap = KeyHeatmap(len(self._key_ids), self.heatmap_window)
         
         # Текущая раскладка (для отображения)
-        self.current_display_layout = self._detect_windows_layout()  # Определяем сразу из Windows
+        self.layout_poll_interval = float(self.config.get('layout_poll_interval', 0.25))
+        language_layouts = {}
+        for name, layout in self.layouts.items():
+            for language_id in layout['language_ids']:
+                language_layouts.setdefault(language_id, name)
+        self.layout_watcher = LayoutWatcher(
+            self._create_layout_backend(),
+            self._on_layout_change,
+            self.layout_poll_interval,
+            language_layouts,
+            self.default_layout
+        )
+        self.layout_watcher.start()
+        
+        # Замер фаз кадра (включается в настройках, вкладка «Производительность»)
+        self.profiler = None
+        self._set_profiling(bool(self.config.get('perf_instrumentation', False)))
+        self.current_display_layout = self.layout_watcher.layout  # Определяем сразу из Windows
+        self._char_to_key = self._layout_tables[self.current_display_layout]['char_to_key']
+        self._mark_startup('layout')
         
         # Настройка окна
         self._setup_window()
         
-        # Canvas
-        self.canvas = tk.Canvas(
-            self.root,
-            bg='black',
-            highlightthickness=0
-        )
-        self.canvas.pack(fill=tk.BOTH, expand=True)
+        # Canvas; вся отрисовка клавиш идёт через self.renderer
+        if headless:
+            self.canvas = None
+            self.renderer = RecordingRenderer()
+        else:
+            self.canvas = tk.Canvas(
+                self.root,
+                bg='black',
+                highlightthickness=0
+            )
+            self.canvas.pack(fill=tk.BOTH, expand=True)
+            self.renderer = CanvasRenderer(self.canvas)
+        
+        # Сцена: элементы canvas создаются один раз, дальше только перенастраиваются
+        self._scene = []  # [{'geo': ..., 'items': {...}, 'glow': [...], 'state': ...}, ...]
+        self._scene_by_key = {}  # {id клавиши: запись сцены} — для перерисовки отдельных клавиш
+        self._scene_dirty = True
+        self._geometry_cache = {}  # {параметры геометрии: {'keys': [...], 'disabled_mask': [...]}}
+        
+        # Палитра: все цвета разобраны заранее, пересобирается только при смене цветов
+        self._alpha_color_cache = {}  # {(цвет, уровень альфы): '#rrggbb'}
+        # Темы проверяются и компилируются в палитры один раз при загрузке
+        self.themes = self._load_themes('themes.json')
+        self._compile_themes()
+        self.current_theme = self.config.get('theme')
+        if self._theme_colors.get(self.current_theme) == self.colors:
+            self._palette = self.theme_palettes[self.current_theme]
+        else:
+            # Цвета правили вручную — тема уже не соответствует
+            self.current_theme = None
+            self._palette = self._compile_palette(self.colors)
+        self._theme_fade = None  # {'ramp': [палитры], 'start': время, 'duration': сек} во время смены темы
+        self._theme_ramps = {}  # {(тема было, тема стало, шагов): рампа}
+        
+        # Атлас спрайтов клавиш (Pillow): {(палитра, подпись, нажата, свечение, нагрев): PhotoImage}
+        self._sprite_atlas = {}
+        self._sprite_fonts = {}
+        self._sprites_active = False
+        # Смена темы в режиме спрайтов: (поколение, палитра), пока спрайты новой темы рисуются в фоне
+        self._sprite_prerender = None
+        self._sprite_generation = 0
+        
+        # Тепловая карта: таймер пересчёта уровней и элемент со скоростью набора
+        self._heatmap_job = None
+        self._speed_item = None
+        self._speed_text = None
         
         if platform.system() == 'Windows':
             self.root.attributes('-transparentcolor', 'black')
         
         # Привязка событий для перетаскивания
-        self.canvas.bind('<Button-1>', self._on_drag_start)
-        self.canvas.bind('<B1-Motion>', self._on_drag_motion)
-        self.canvas.bind('<ButtonRelease-1>', self._on_drag_end)
+        if self.canvas is not None:
+            self.canvas.bind('<Button-1>', self._on_drag_start)
+            self.canvas.bind('<B1-Motion>', self._on_drag_motion)
+            self.canvas.bind('<ButtonRelease-1>', self._on_drag_end)
+        self._mark_startup('window')
         
         # Listener для клавиш
         self.listener = None
-        self._start_key_listener()
+        self.listener_thread = None
+        if start_listener and not headless:
+            self._start_key_listener()
+        self._mark_startup('listener')
 
         # Настройки (окно + трей)
         self.settings_window = None
-        self.themes = self._load_themes('themes.json')
+        self._refresh_settings = None  # переменные окна настроек ← текущие настройки (см. _create_settings_window)
         self.tray_icon = None
         self.tray_thread = None
-        self.tray_status_var = tk.StringVar(value="Трей: инициализация...")
+        self._closing = False
+        self.tray_status_var = None if headless else tk.StringVar(value="Трей: инициализация...")
         # Запускаем трей сразу (после старта Tk), так стабильнее на Windows
-        self.root.after(100, self._setup_tray)
-        # Окно настроек НЕ показываем при запуске — только по клику из трея
-        self._create_settings_window(show=False)
+        if start_tray and not headless:
+            self.root.after(100, self._setup_tray)
+        # Окно настроек НЕ создаём при запуске — только по клику из трея
         
-        # Анимация
+        # Правки config.json/themes.json извне (например, от центрального деплоя) — без перезапуска
+        self._themes_path = os.path.abspath('themes.json')
+        self.file_watcher = FileWatcher(
+            [config_path, self._themes_path],
+            self._on_file_changed,
+            self.config.get('config_watch_interval', 1.0) or 1.0
+        )
+        if self.config.get('config_watch_interval', 1.0) and not headless:
+            self.file_watcher.start()
+        
+        # Анимация: тикаем только пока что-то меняется, в покое цикл спит
+        self._animation_job = None
+        self._animation_job_is_wake = False
+        self._frame_due = None
+        self._wake_on_input = False
+        self._overlay_hidden = False
+        if self.display_mode == 'heatmap':
+            self._heatmap_tick()
         self._animate()
+        self._mark_startup('first_frame')
+    
+    def _pad_visible_rows(self, rows):
+        """Старые конфиги знают только 4 ряда: ряд служебных клавиш по умолчанию скрыт"""
+        return list(rows) + [row_idx < 4 for row_idx in range(len(rows), len(self.base_layout))]
+    
+    def _mark_startup(self, phase):
+        """Записать длительность фазы запуска (от предыдущей отметки)"""
+        now = time.perf_counter()
+        self.startup_phases.append((phase, (now - self._startup_mark) * 1000))
+        self._startup_mark = now
+    
+    def _compile_key_table(self):
+        """Нумерует физические клавиши, собирает таблицы раскладок и буферы состояния нажатий"""
+        key_ids = {}  # {(ряд, колонка): id}
+        for layout in self.layouts.values():
+            for row_idx, row in enumerate(layout['rows']):
+                for col_idx in range(len(row)):
+                    key_ids.setdefault((row_idx, col_idx), len(key_ids))
+        
+        # Символы всех раскладок: pynput может вернуть символ не той раскладки, что на экране.
+        # Базовая раскладка в приоритете, затем остальные по порядку
+        order = [self.default_layout] + [name for name in self.layouts if name != self.default_layout]
+        any_layout = {}
+        for name in order:
+            for row_idx, row in enumerate(self.layouts[name]['rows']):
+                for col_idx, char in enumerate(row):
+                    any_layout.setdefault(char, key_ids[(row_idx, col_idx)])
+        
+        # Для каждой раскладки — готовый индекс символ → id (свои символы важнее чужих) и подписи
+        special_labels = {special[0]: special[1] for special in self.SPECIAL_KEYS}
+        tables = {}
+        for name, layout in self.layouts.items():
+            char_to_key = dict(any_layout)
+            labels = {}
+            for row_idx, row in enumerate(layout['rows']):
+                for col_idx, char in enumerate(row):
+                    char_to_key[char] = key_ids[(row_idx, col_idx)]
+                    label = special_labels.get(char)
+                    if label is None:
+                        # У ß и подобных заглавная форма длиннее одного символа — оставляем как есть
+                        upper = char.upper()
+                        label = upper if len(upper) == 1 else char
+                    labels[(row_idx, col_idx)] = label
+            tables[name] = {'rows': layout['rows'], 'char_to_key': char_to_key, 'labels': labels}
+        
+        # Идентичность клавиши по скан-коду / коду VK / имени pynput.Key — одна целочисленная
+        # выборка на событие, символ нужен только если pynput не дал кода
+        special_row = len(self.SCAN_CODES)  # _load_layouts гарантирует этот индекс у всех раскладок
+        scan_to_key = {}
+        vk_to_key = {}
+        for row_idx, codes in enumerate(self.SCAN_CODES):
+            for col_idx, code in enumerate(codes):
+                if (row_idx, col_idx) in key_ids:
+                    scan_to_key[code] = key_ids[(row_idx, col_idx)]
+        for row_idx, codes in enumerate(self.VK_CODES):
+            for col_idx, code in enumerate(codes):
+                if (row_idx, col_idx) in key_ids:
+                    vk_to_key[code] = key_ids[(row_idx, col_idx)]
+        special_to_key = {}
+        for col_idx, (_, _, _, scan, vks, names) in enumerate(self.SPECIAL_KEYS):
+            key_id = key_ids[(special_row, col_idx)]
+            scan_to_key[scan] = key_id
+            for vk in vks:
+                vk_to_key[vk] = key_id
+            for key_name in names:
+                special_to_key[key_name] = key_id
+        
+        self._key_ids = key_ids
+        self._layout_tables = tables
+        self._scan_to_key = scan_to_key
+        # Коды VK есть только в Windows (в X11 pynput отдаёт в vk keysym)
+        self._vk_to_key = vk_to_key if platform.system() == 'Windows' else {}
+        self._special_to_key = special_to_key
+        self._key_units = {special[0]: special[2] for special in self.SPECIAL_KEYS}
+        # Время нажатия и яркость подсветки по id; в _active_keys — id с яркостью > 0
+        self._press_times = array('d', [0.0]) * len(key_ids)
+        self._press_alpha = array('d', [0.0]) * len(key_ids)
+        self._active_keys = []
     
-    def _load_config(self, config_path):
-        """Загрузка конфигурации"""
+    def _load_config(self, config_path, user_config=None):
+        """Загрузка конфигурации (user_config — уже прочитанное содержимое файла)"""
         default = {
             'position': 'bottom',
             'custom_x': None,
@@ -154,7 +1342,7 @@ class KeyboardOverlay:
             'height': 300,
             'max_alpha': 0.92,
             'min_alpha': 0.30,
-            'visible_rows': [True, True, True, True],
+            'visible_rows': [True, True, True, True, False],
             'disabled_keys': {},
             'tray_icon_path': 'tray.ico',
             'key_style': 'rounded',
@@ -163,37 +1351,43 @@ class KeyboardOverlay:
             'glow_intensity': 1.0,
             'border_width': 2,
             'key_padding': 6,
-            'colors': {
-                'bg': '#00000000',
-                'key_bg': '#30202030',
-                'key_border': '#60ffffff',
-                'key_text': '#ffffff',
-                'key_pressed': '#00d4ff',
-                'key_pressed_text': '#000000',
-                'key_pressed_border': '#00ffff',
-                'key_shadow': '#20000000',
-                'key_highlight': '#40ffffff',
-            },
+            'render_backend': 'canvas',
+            'display_mode': 'keys',
+            'heatmap_window': 60.0,
+            'colors': dict(self.DEFAULT_COLORS),
+            'theme': None,
+            'theme_crossfade': 0.4,
             'idle_timeout': 5.0,
             'fade_duration': 2.0,
             'key_fade_duration': 0.8,
+            'key_fade_easing': 'linear',
+            'immediate_redraw': True,
+            'target_fps': 60,
+            'layout_poll_interval': 0.25,
+            'perf_instrumentation': False,
+            'log_level': 'INFO',
+            'log_max_bytes': 1_000_000,
+            'save_debounce': 0.5,
+            'config_watch_interval': 1.0,
         }
         
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    user_config = json.load(f)
-                    default.update(user_config)
-                    if 'colors' in user_config:
-                        default['colors'].update(user_config['colors'])
-            except:
-                pass
+        if user_config is None:
+            user_config = ConfigStore.read(config_path)
+        if user_config:
+            default.update(user_config)
+            if isinstance(user_config.get('colors'), dict):
+                default['colors'].update(user_config['colors'])
         
         return default
 
     def _save_config(self):
         """Сохранение конфигурации в JSON"""
-        data = {
+        # Запись уходит в фоновый поток; неизвестные поля файла хранит config_store
+        self.config_store.update(self._config_values())
+
+    def _config_values(self):
+        """Текущие настройки в виде полей config.json"""
+        return {
             'position': self.position,
             'custom_x': self.custom_x,
             'custom_y': self.custom_y,
@@ -211,61 +1405,423 @@ class KeyboardOverlay:
             'glow_intensity': self.glow_intensity,
             'border_width': self.border_width,
             'key_padding': self.key_padding,
+            'render_backend': self.render_backend,
+            'display_mode': self.display_mode,
+            'heatmap_window': self.heatmap_window,
             'colors': self.colors,
+            'theme': self.current_theme,
+            'theme_crossfade': self.theme_crossfade,
             'idle_timeout': self.idle_timeout,
             'fade_duration': self.fade_duration,
             'key_fade_duration': self.key_fade_duration,
+            'key_fade_easing': self.key_fade_easing,
+            'immediate_redraw': self.immediate_redraw,
+            'target_fps': self.pacer.target_fps,
+            'layout_poll_interval': self.layout_poll_interval,
+            'perf_instrumentation': self.profiler is not None,
         }
-        try:
-            # Сохраняем неизвестные поля из существующего файла (например default_layout)
-            merged = {}
-            if os.path.exists(self.config_path):
-                try:
-                    with open(self.config_path, 'r', encoding='utf-8') as f:
-                        existing = json.load(f)
-                        if isinstance(existing, dict):
-                            merged.update(existing)
-                except Exception:
-                    pass
 
-            # Аккуратно мерджим colors
-            if isinstance(merged.get('colors'), dict) and isinstance(data.get('colors'), dict):
-                merged['colors'].update(data['colors'])
-                data = dict(data)
-                data.pop('colors', None)
-
-            merged.update(data)
-            with open(self.config_path, 'w', encoding='utf-8') as f:
-                json.dump(merged, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось сохранить {self.config_path}\n\n{e}")
-
-    def _log(self, msg: str):
+    def _on_config_save_error(self, error):
+        """Ошибка фоновой записи конфигурации (поток записи)"""
+        self._log(f"Config save failed: {error!r}", 'ERROR')
         try:
-            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with open(self.log_path, 'a', encoding='utf-8') as f:
-                f.write(f"[{ts}] {msg}\n")
+            self.root.after(0, lambda: messagebox.showerror(
+                "Ошибка", f"Не удалось сохранить {self.config_path}\n\n{error}"))
         except Exception:
             pass
 
+    def _log(self, msg: str, level='INFO'):
+        """Запись в лог без дискового I/O в вызывающем потоке"""
+        self.logger.log(msg, level)
+
+    def _set_profiling(self, enabled):
+        """Включить/выключить замер фаз кадра"""
+        if enabled and self.profiler is None:
+            self.profiler = FrameProfiler(budget_ms=1000.0 / self.pacer.target_fps)
+        elif not enabled:
+            self.profiler = None
+        self.layout_watcher.profiler = self.profiler
+
+    def _set_fade_easing(self, name):
+        """Сменить кривую затухания клавиш (неизвестное имя — линейная)"""
+        self.key_fade_easing = name if name in self.FADE_EASINGS else 'linear'
+        self._fade_lut = self._compile_fade_easing(self.key_fade_easing)
+
+    def _compile_fade_easing(self, name):
+        """Яркость клавиши по доле прошедшего затухания: EASING_STEPS значений, первое 1.0, все > 0"""
+        steps = self.EASING_STEPS
+        tail = math.exp(-5)
+        lut = array('d')
+        for i in range(steps):
+            p = i / steps
+            if name == 'ease_out':
+                value = (1 - p) ** 3
+            elif name == 'exponential':
+                value = (math.exp(-5 * p) - tail) / (1 - tail)
+            elif name == 'spring':
+                # Затухающие «пружинные» вспышки
+                value = (1 - p) * math.exp(-2 * p) * (0.7 + 0.3 * math.cos(6 * math.pi * p))
+            else:
+                value = 1 - p
+            lut.append(max(value, 1e-6))
+        return lut
+
+    def _set_target_fps(self, target_fps):
+        """Сменить частоту кадров анимации"""
+        self.pacer.set_fps(target_fps)
+        self._alpha_step = 1 - 0.9 ** (60 / self.pacer.target_fps)
+        if self.profiler is not None:
+            self.profiler.budget_ms = 1000.0 / self.pacer.target_fps
+
+    def _log_profile(self):
+        """Сбросить гистограммы фаз кадра в лог"""
+        self._log(f"Perf: {self.latency.report_line()}")
+        if self.profiler is None:
+            self._log(f"Perf: {self.pacer.report_line()} (instrumentation disabled)")
+            return
+        self._log(f"Perf: {self.pacer.report_line()}")
+        for line in self.profiler.report_lines():
+            self._log(f"Perf: {line}")
+
+    def _load_layouts(self, layouts_path):
+        """Загрузка раскладок из layouts.json (если файла нет — встроенные en/ru)"""
+        data = {}
+        if os.path.exists(layouts_path):
+            try:
+                with open(layouts_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                self._log(f"Layouts: failed to read {layouts_path}: {e!r}", 'WARNING')
+        if not isinstance(data, dict):
+            data = {}
+        layouts = {}
+        for name, layout in data.items():
+            try:
+                rows = [[str(char).lower() for char in row] for row in layout['rows']]
+                language_ids = [int(str(lid), 0) for lid in layout.get('language_ids', [])]
+            except Exception as e:
+                self._log(f"Layouts: skipping '{name}': {e!r}", 'WARNING')
+                continue
+            if not rows or not all(rows):
+                self._log(f"Layouts: skipping '{name}': empty rows", 'WARNING')
+                continue
+            if len(rows) != len(self.SCAN_CODES):
+                # Скан-коды и ряд служебных клавиш привязаны к позициям четырёх рядов символов
+                self._log(f"Layouts: skipping '{name}': expected {len(self.SCAN_CODES)} rows, got {len(rows)}",
+                          'WARNING')
+                continue
+            layouts[name] = {
+                'name': layout.get('name', name),
+                'language_ids': language_ids,
+                'rows': rows,
+            }
+        if not layouts:
+            layouts = {name: dict(layout) for name, layout in self.BUILTIN_LAYOUTS.items()}
+        # Служебные клавиши не зависят от раскладки — общий последний ряд
+        special_row = [special[0] for special in self.SPECIAL_KEYS]
+        for layout in layouts.values():
+            layout['rows'] = list(layout['rows']) + [special_row]
+        return layouts
+    
     def _load_themes(self, themes_path):
-        """Загрузка тем из themes.json (если есть)"""
+        """Загрузка тем из themes.json (если есть); темы с ошибками пропускаются"""
         if not os.path.exists(themes_path):
             return {}
         try:
             with open(themes_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            return data if isinstance(data, dict) else {}
-        except Exception:
+        except Exception as e:
+            self._log(f"Themes: cannot read {themes_path}: {e}", 'WARNING')
             return {}
+        if not isinstance(data, dict):
+            return {}
+        
+        themes = {}
+        for theme_id, theme in data.items():
+            colors = theme.get('colors') if isinstance(theme, dict) else None
+            if not isinstance(colors, dict):
+                self._log(f"Themes: '{theme_id}' skipped: no colors", 'WARNING')
+                continue
+            bad = [k for k, v in colors.items()
+                   if k in self.DEFAULT_COLORS and not (isinstance(v, str) and self.COLOR_RE.match(v))]
+            if bad:
+                self._log(f"Themes: '{theme_id}' skipped: invalid colors {bad}", 'WARNING')
+                continue
+            themes[theme_id] = {
+                'name': str(theme.get('name') or theme_id),
+                'colors': {k: v for k, v in colors.items() if k in self.DEFAULT_COLORS},
+            }
+        return themes
+    
+    def _compile_themes(self):
+        """Готовые неизменяемые палитры всех тем: смена темы не разбирает строки цветов"""
+        self.theme_palettes = {}
+        self._theme_colors = {}
+        for theme_id, theme in self.themes.items():
+            colors = dict(self.DEFAULT_COLORS)
+            colors.update(theme['colors'])
+            self._theme_colors[theme_id] = colors
+            self.theme_palettes[theme_id] = self._compile_palette(colors, key=theme_id)
+    
+    def _on_file_changed(self, path):
+        """Файл изменился (поток FileWatcher): читаем здесь, применяем в потоке Tk"""
+        if path == self._themes_path:
+            themes = self._load_themes(path)
+            self.root.after(0, lambda: self._reload_themes(themes))
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except OSError:
+            return
+        if self.config_store.is_own_write(text):
+            return  # эхо нашей же записи
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            # Файл дописывается или битый — дождёмся следующего изменения
+            self._log(f"Config reload: cannot parse {path}", 'WARNING')
+            return
+        self.root.after(0, lambda: self._reload_config(data))
+    
+    def _reload_config(self, user_config):
+        """Применить config.json, изменённый извне: только поля, которые поменялись в самом файле.
+
+        Сравниваем с тем, каким файл был до правки (config_store), а не с текущими настройками —
+        иначе применённые, но ещё не сохранённые изменения (кнопка «Применить», перетаскивание) откатятся.
+        """
+        previous = self._load_config(self.config_path, self.config_store.disk_snapshot())
+        new = self._load_config(self.config_path, user_config)
+        changed = {k for k in self._config_values() if new.get(k) != previous.get(k)}
+        self.config_store.reload(user_config, changed)
+        if not changed:
+            return
+        self._log(f"Config reload: {', '.join(sorted(changed))}")
+        self.config.update({k: new[k] for k in changed})
+        new['visible_rows'] = self._pad_visible_rows(new['visible_rows'])
+        
+        # Простые значения — читаются в каждом кадре
+        for name in changed & {'max_alpha', 'min_alpha', 'idle_timeout', 'fade_duration',
+                               'key_fade_duration', 'glow_intensity', 'tray_icon_path'}:
+            setattr(self, name, new[name])
+        if 'theme_crossfade' in changed:
+            self.theme_crossfade = max(0.0, float(new['theme_crossfade']))
+        if 'immediate_redraw' in changed:
+            self.immediate_redraw = bool(new['immediate_redraw'])
+        if 'key_fade_easing' in changed:
+            self._set_fade_easing(new['key_fade_easing'])
+        if 'target_fps' in changed:
+            self._set_target_fps(new['target_fps'])
+        if 'perf_instrumentation' in changed:
+            self._set_profiling(bool(new['perf_instrumentation']))
+        if 'layout_poll_interval' in changed:
+            self.layout_poll_interval = float(new['layout_poll_interval'])
+            self.layout_watcher.poll_interval = max(0.02, self.layout_poll_interval)
+        
+        # Положение и размер окна — без пересоздания сцены
+        window_fields = changed & {'position', 'custom_x', 'custom_y', 'width', 'height'}
+        if window_fields:
+            for name in window_fields:
+                setattr(self, name, new[name])
+            self._apply_geometry()
+        
+        # Раскладка, видимость и стиль клавиш — новая геометрия и сцена; атлас спрайтов тоже
+        # устарел (его ключ не включает стиль и размеры)
+        scene_fields = changed & {'width', 'scale', 'key_padding', 'border_radius', 'key_style', 'shadow_size',
+                                  'border_width', 'render_backend', 'visible_rows', 'disabled_keys'}
+        if scene_fields:
+            for name in scene_fields:
+                setattr(self, name, new[name])
+            self._invalidate_geometry()
+        if changed & {'display_mode', 'heatmap_window'}:
+            self._set_display_mode(new['display_mode'], new['heatmap_window'])
+        
+        # Цвета — только палитра и перекраска готовых элементов
+        if changed & {'colors', 'theme'}:
+            theme_id = new['theme']
+            if self._theme_colors.get(theme_id) == new['colors']:
+                # Правка пришла из файла — записывать его обратно незачем
+                self._apply_theme(theme_id, save=False)
+            else:
+                self.colors = dict(new['colors'])
+                self.current_theme = None
+                self._theme_fade = None
+                self._sprite_prerender = None
+                self._palette = self._compile_palette(self.colors)
+                self._sprite_atlas.clear()
+                self._recolor_scene()
+        
+        self.target_alpha = min(self.target_alpha, self.max_alpha)
+        self._request_animation()
+        if self._refresh_settings:
+            self._refresh_settings(changed)
+    
+    def _reload_themes(self, themes):
+        """Применить themes.json, изменённый извне (поток Tk)"""
+        if themes == self.themes:
+            return
+        self._log(f"Themes reload: {len(themes)} themes")
+        self.themes = themes
+        self._compile_themes()
+        self._theme_ramps.clear()
+        self._sprite_atlas.clear()
+        if self.current_theme in self.theme_palettes:
+            if self._theme_colors[self.current_theme] != self.colors:
+                self._apply_theme(self.current_theme, save=False)
+            elif self._theme_fade is None:
+                self._palette = self.theme_palettes[self.current_theme]
+        else:
+            self.current_theme = None
+        self._update_tray_menu()
+    
+    def _apply_theme(self, theme_id, crossfade=True, save=True):
+        """Переключить тему без пересоздания сцены (только из потока Tk); save=False — при перечитывании файлов"""
+        palette = self.theme_palettes.get(theme_id)
+        if palette is None:
+            return
+        self.colors = dict(self._theme_colors[theme_id])
+        self.current_theme = theme_id
+        
+        old = self._palette
+        steps = min(self.CROSSFADE_MAX_STEPS, int(self.theme_crossfade * self.pacer.target_fps))
+        self._sprite_prerender = None
+        if self._sprites_active and not self._scene_dirty:
+            # Спрайты на каждый шаг рампы пришлось бы рисовать заново — в этом режиме без перехода;
+            # спрайты новой темы рисуются в фоне, палитра сменится, когда они готовы
+            self._theme_fade = None
+            self._prerender_sprites(palette)
+        elif crossfade and steps > 1 and old is not palette:
+            self._theme_fade = {
+                'ramp': self._theme_ramp(old, palette, steps),
+                'start': time.monotonic(),
+                'duration': self.theme_crossfade,
+            }
+        else:
+            self._theme_fade = None
+            self._palette = palette
+            self._recolor_scene()
+        self._request_animation()
+        if save:
+            self._save_config()
+        if self._refresh_settings:
+            self._refresh_settings({'colors', 'theme'})
+    
+    def _prerender_sprites(self, palette):
+        """Нарисовать спрайты сцены под palette в фоновом потоке, затем переключить палитру.
+
+        Pillow с суперсэмплингом рисует атлас заметное время — в потоке Tk это был бы рывок.
+        Заготавливаются текущие состояния клавиш и отпущенные; нажатые дорисуются при первом нажатии.
+        """
+        pending = {}
+        for record in self._scene:
+            geo = record['geo']
+            heat = record['state'][2] if record['state'] else 0
+            for state in {(False, 0.0, heat), record['state'] or (False, 0.0, 0)}:
+                atlas_key = (palette['key'], geo['label']) + state
+                if atlas_key not in self._sprite_atlas:
+                    pending[atlas_key] = (geo, state)
+        if not pending:
+            self._palette = palette
+            self._recolor_scene()
+            return
+        
+        self._sprite_generation += 1
+        generation = self._sprite_generation
+        self._sprite_prerender = (generation, palette)
+        
+        def render():
+            try:
+                images = {atlas_key: self._render_key_sprite(geo, *state, palette=palette)
+                          for atlas_key, (geo, state) in pending.items()}
+            except Exception as e:
+                self._log(f"Sprite prerender failed: {e}", 'WARNING')
+                images = {}
+            self.root.after(0, lambda: self._finish_prerender(generation, images))
+        
+        threading.Thread(target=render, daemon=True).start()
+    
+    def _finish_prerender(self, generation, images):
+        """Спрайты новой темы готовы (поток Tk): положить в атлас и переключить палитру"""
+        if self._sprite_prerender is None or self._sprite_prerender[0] != generation:
+            return  # тему успели сменить ещё раз или сбросили геометрию
+        palette = self._sprite_prerender[1]
+        self._sprite_prerender = None
+        for atlas_key, image in images.items():
+            self._sprite_atlas[atlas_key] = ImageTk.PhotoImage(image, master=self.root)
+        self._palette = palette
+        self._recolor_scene()
+        self._request_animation()
+    
+    def _theme_ramp(self, old, new, steps):
+        """Палитры промежуточных шагов перехода; для пар тем кэшируются"""
+        # Переход начат с промежуточной палитры (прошлый переход не закончился) — не кэшируем
+        cacheable = old is self.theme_palettes.get(old['key'])
+        cache_key = (old['key'], new['key'], steps)
+        ramp = self._theme_ramps.get(cache_key) if cacheable else None
+        if ramp is None:
+            ramp = [self._freeze(self._mix_palettes(old, new, i / steps)) for i in range(1, steps)]
+            ramp.append(new)
+            if cacheable:
+                self._theme_ramps[cache_key] = ramp
+        return ramp
+    
+    def _mix_palettes(self, a, b, t):
+        """Промежуточная палитра: цвета #rrggbb смешиваются, прочие значения переключаются на середине"""
+        if isinstance(a, MappingProxyType):
+            return {k: self._mix_palettes(a[k], b[k], t) for k in a}
+        if isinstance(a, tuple):
+            return [self._mix_palettes(x, y, t) for x, y in zip(a, b)]
+        if isinstance(a, str) and isinstance(b, str) and len(a) == len(b) == 7 and a[0] == b[0] == '#':
+            return self._mix_colors(a, b, t)
+        if a == '' and isinstance(b, str) and len(b) == 7:
+            # Прозрачное → цвет: проявляем из чёрного (чёрный у окна прозрачный)
+            return self._mix_colors('#000000', b, t) if t > 0 else ''
+        if b == '' and isinstance(a, str) and len(a) == 7:
+            return self._mix_colors(a, '#000000', t) if t < 1 else ''
+        return b if t >= 0.5 else a
+    
+    def _step_theme_fade(self, now):
+        """Шаг перехода между темами: берём готовую палитру из рампы"""
+        fade = self._theme_fade
+        ramp = fade['ramp']
+        progress = (now - fade['start']) / fade['duration'] if fade['duration'] > 0 else 1.0
+        palette = ramp[min(len(ramp) - 1, int(progress * len(ramp)))]
+        if progress >= 1.0:
+            self._theme_fade = None
+        if palette is not self._palette:
+            self._palette = palette
+            self._recolor_scene()
+    
+    def _recolor_scene(self):
+        """Перекрасить готовую сцену под self._palette: O(клавиш) itemconfigure, без пересоздания"""
+        palette = self._palette
+        decor = (
+            ('shadow', palette['shadow']),
+            ('bottom', palette['bottom_3d']),
+            ('highlight', palette['highlight']),
+            ('reflection', palette['reflection']),
+        )
+        for record in self._scene:
+            items = record['items']
+            for name, color in decor:
+                if name in items:
+                    self.renderer.configure(items[name], fill=color or '')
+            # Тело, текст и свечение перенастроит _draw_keyboard в ближайшем кадре
+            record['state'] = None
+        if self._speed_item is not None:
+            self.renderer.configure(self._speed_item, fill=palette['normal']['text'])
     
     def _setup_window(self):
         """Настройка окна"""
         self.root.overrideredirect(True)
         self.root.attributes('-topmost', True)
+        # Альфа, геометрия и click-through дальше идут только через window_state
+        self.window_state = WindowState(self.root, self.pacer)
         
         if platform.system() == 'Windows':
-            self.root.attributes('-alpha', self.max_alpha)
+            self.window_state.set_alpha(self.max_alpha)
             self.root.configure(bg='black')
         
         self._apply_geometry()
@@ -273,27 +1829,11 @@ class KeyboardOverlay:
         # Делаем окно прозрачным для кликов мыши (click-through)
         if platform.system() == 'Windows' and not self.drag_mode:
             self._set_click_through(True)
+        self.window_state.flush()
     
     def _set_click_through(self, enabled):
         """Включить/выключить режим прозрачности для кликов"""
-        if platform.system() != 'Windows':
-            return
-            
-        self.root.update_idletasks()
-        hwnd = ctypes.windll.user32.GetParent(self.root.winfo_id())
-        
-        GWL_EXSTYLE = -20
-        WS_EX_LAYERED = 0x00080000
-        WS_EX_TRANSPARENT = 0x00000020
-        
-        style = ctypes.windll.user32.GetWindowLongW(hwnd, GWL_EXSTYLE)
-        
-        if enabled:
-            style = style | WS_EX_LAYERED | WS_EX_TRANSPARENT
-        else:
-            style = (style | WS_EX_LAYERED) & ~WS_EX_TRANSPARENT
-        
-        ctypes.windll.user32.SetWindowLongW(hwnd, GWL_EXSTYLE, style)
+        self.window_state.set_click_through(enabled)
 
     def _apply_geometry(self):
         """Применить геометрию/позицию без пересоздания окна"""
@@ -320,7 +1860,7 @@ class KeyboardOverlay:
             x = (screen_width - self.width) // 2
             y = (screen_height - self.height) // 2
 
-        self.root.geometry(f"{self.width}x{self.height}+{x}+{y}")
+        self.window_state.set_geometry(self.width, self.height, x, y)
 
     def _on_drag_start(self, event):
         """Начало перетаскивания"""
@@ -328,8 +1868,7 @@ class KeyboardOverlay:
             return
         self.drag_start_x = event.x_root
         self.drag_start_y = event.y_root
-        self.window_start_x = self.root.winfo_x()
-        self.window_start_y = self.root.winfo_y()
+        self.window_start_x, self.window_start_y = self.window_state.position()
     
     def _on_drag_motion(self, event):
         """Перетаскивание"""
@@ -339,15 +1878,15 @@ class KeyboardOverlay:
         dy = event.y_root - self.drag_start_y
         new_x = self.window_start_x + dx
         new_y = self.window_start_y + dy
-        self.root.geometry(f"+{new_x}+{new_y}")
+        # Пачка событий мыши между кадрами даёт один вызов geometry()
+        self.window_state.set_position(new_x, new_y)
     
     def _on_drag_end(self, event):
         """Завершение перетаскивания"""
         if not self.drag_mode:
             return
         # Сохраняем новую позицию
-        self.custom_x = self.root.winfo_x()
-        self.custom_y = self.root.winfo_y()
+        self.custom_x, self.custom_y = self.window_state.position()
         self.position = 'custom'
     
     def _toggle_drag_mode(self, enabled=None):
@@ -363,7 +1902,7 @@ class KeyboardOverlay:
         return self.drag_mode
 
     def _create_settings_window(self, show=False):
-        """Окно настроек с вкладками"""
+        """Окно настроек с вкладками (содержимое вкладки строится при первом открытии)"""
         if self.settings_window and tk.Toplevel.winfo_exists(self.settings_window):
             if show:
                 self._show_settings()
@@ -398,192 +1937,220 @@ class KeyboardOverlay:
         notebook = ttk.Notebook(main_frame)
         notebook.pack(fill=tk.BOTH, expand=True)
 
+        # Переменные UI появляются по мере построения вкладок;
+        # apply_settings читает только то, что уже построено
+        ui = {}
+
         # ==================== Вкладка 1: Основные ====================
-        tab_main = ttk.Frame(notebook, padding=15)
-        notebook.add(tab_main, text="📍 Основные")
-
-        # --- Переменные UI
-        position_var = tk.StringVar(value=self.position)
-        width_var = tk.IntVar(value=int(self.width))
-        height_var = tk.IntVar(value=int(self.height))
-        scale_var = tk.DoubleVar(value=float(self.scale))
-        max_alpha_var = tk.DoubleVar(value=float(self.max_alpha))
-        min_alpha_var = tk.DoubleVar(value=float(self.min_alpha))
-        idle_timeout_var = tk.DoubleVar(value=float(self.idle_timeout))
-        key_fade_duration_var = tk.DoubleVar(value=float(self.key_fade_duration))
-        drag_mode_var = tk.BooleanVar(value=self.drag_mode)
-
-        # Положение
-        lf_pos = ttk.Labelframe(tab_main, text="Положение на экране", padding=10)
-        lf_pos.pack(fill=tk.X, pady=(0, 10))
-
-        pos_frame = ttk.Frame(lf_pos)
-        pos_frame.pack(fill=tk.X)
-
-        ttk.Label(pos_frame, text="Позиция:").grid(row=0, column=0, sticky="w")
-        pos_cb = ttk.Combobox(pos_frame, textvariable=position_var, state="readonly",
-                              values=["bottom", "top", "left", "right", "center", "custom"], width=15)
-        pos_cb.grid(row=0, column=1, sticky="w", padx=(10, 0))
-
-        # Кнопка для интерактивного перемещения
-        def toggle_drag():
-            enabled = self._toggle_drag_mode()
-            drag_mode_var.set(enabled)
-            if enabled:
-                drag_btn.configure(text="🔓 Завершить перемещение")
-                messagebox.showinfo("Режим перемещения", 
-                    "Теперь вы можете перетаскивать клавиатуру мышью!\n\n"
-                    "Нажмите кнопку снова чтобы зафиксировать положение.")
-            else:
-                drag_btn.configure(text="🔒 Переместить клавиатуру")
-                position_var.set('custom')
+        def build_main_tab(tab_main):
+            position_var = ui['position'] = tk.StringVar(value=self.position)
+            width_var = ui['width'] = tk.IntVar(value=int(self.width))
+            height_var = ui['height'] = tk.IntVar(value=int(self.height))
+            scale_var = ui['scale'] = tk.DoubleVar(value=float(self.scale))
+            max_alpha_var = ui['max_alpha'] = tk.DoubleVar(value=float(self.max_alpha))
+            min_alpha_var = ui['min_alpha'] = tk.DoubleVar(value=float(self.min_alpha))
+            idle_timeout_var = ui['idle_timeout'] = tk.DoubleVar(value=float(self.idle_timeout))
+            key_fade_duration_var = ui['key_fade_duration'] = tk.DoubleVar(value=float(self.key_fade_duration))
+            target_fps_var = ui['target_fps'] = tk.StringVar(value=f"{self.pacer.target_fps:g}")
+            key_fade_easing_var = ui['key_fade_easing'] = tk.StringVar(value=self.key_fade_easing)
+            drag_mode_var = tk.BooleanVar(value=self.drag_mode)
+
+            # Положение
+            lf_pos = ttk.Labelframe(tab_main, text="Положение на экране", padding=10)
+            lf_pos.pack(fill=tk.X, pady=(0, 10))
+
+            pos_frame = ttk.Frame(lf_pos)
+            pos_frame.pack(fill=tk.X)
+
+            ttk.Label(pos_frame, text="Позиция:").grid(row=0, column=0, sticky="w")
+            pos_cb = ttk.Combobox(pos_frame, textvariable=position_var, state="readonly",
+                                  values=["bottom", "top", "left", "right", "center", "custom"], width=15)
+            pos_cb.grid(row=0, column=1, sticky="w", padx=(10, 0))
+
+            # Кнопка для интерактивного перемещения
+            def toggle_drag():
+                enabled = self._toggle_drag_mode()
+                drag_mode_var.set(enabled)
+                if enabled:
+                    drag_btn.configure(text="🔓 Завершить перемещение")
+                    messagebox.showinfo("Режим перемещения", 
+                        "Теперь вы можете перетаскивать клавиатуру мышью!\n\n"
+                        "Нажмите кнопку снова чтобы зафиксировать положение.")
+                else:
+                    drag_btn.configure(text="🔒 Переместить клавиатуру")
+                    position_var.set('custom')
 
-        drag_btn = ttk.Button(pos_frame, text="🔒 Переместить клавиатуру", command=toggle_drag)
-        drag_btn.grid(row=0, column=2, padx=(20, 0))
+            drag_btn = ttk.Button(pos_frame, text="🔒 Переместить клавиатуру", command=toggle_drag)
+            drag_btn.grid(row=0, column=2, padx=(20, 0))
 
-        def reset_position():
-            self.custom_x = None
-            self.custom_y = None
-            self.position = position_var.get() if position_var.get() != 'custom' else 'bottom'
-            position_var.set(self.position)
-            self._apply_geometry()
+            def reset_position():
+                self.custom_x = None
+                self.custom_y = None
+                self.position = position_var.get() if position_var.get() != 'custom' else 'bottom'
+                position_var.set(self.position)
+                self._apply_geometry()
 
-        ttk.Button(pos_frame, text="Сбросить", command=reset_position).grid(row=0, column=3, padx=(10, 0))
+            ttk.Button(pos_frame, text="Сбросить", command=reset_position).grid(row=0, column=3, padx=(10, 0))
 
-        # Размеры
-        lf_size = ttk.Labelframe(tab_main, text="Размеры", padding=10)
-        lf_size.pack(fill=tk.X, pady=(0, 10))
+            # Размеры
+            lf_size = ttk.Labelframe(tab_main, text="Размеры", padding=10)
+            lf_size.pack(fill=tk.X, pady=(0, 10))
 
-        size_grid = ttk.Frame(lf_size)
-        size_grid.pack(fill=tk.X)
+            size_grid = ttk.Frame(lf_size)
+            size_grid.pack(fill=tk.X)
 
-        ttk.Label(size_grid, text="Ширина:").grid(row=0, column=0, sticky="w")
-        ttk.Entry(size_grid, textvariable=width_var, width=10).grid(row=0, column=1, sticky="w", padx=(10, 30))
-        ttk.Label(size_grid, text="Высота:").grid(row=0, column=2, sticky="w")
-        ttk.Entry(size_grid, textvariable=height_var, width=10).grid(row=0, column=3, sticky="w", padx=(10, 0))
+            ttk.Label(size_grid, text="Ширина:").grid(row=0, column=0, sticky="w")
+            ttk.Entry(size_grid, textvariable=width_var, width=10).grid(row=0, column=1, sticky="w", padx=(10, 30))
+            ttk.Label(size_grid, text="Высота:").grid(row=0, column=2, sticky="w")
+            ttk.Entry(size_grid, textvariable=height_var, width=10).grid(row=0, column=3, sticky="w", padx=(10, 0))
 
-        ttk.Label(size_grid, text="Масштаб клавиш:").grid(row=1, column=0, sticky="w", pady=(10, 0))
-        scale_frame = ttk.Frame(size_grid)
-        scale_frame.grid(row=1, column=1, columnspan=3, sticky="ew", padx=(10, 0), pady=(10, 0))
-        ttk.Scale(scale_frame, variable=scale_var, from_=0.3, to=2.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(scale_frame, textvariable=scale_var, width=6).pack(side=tk.LEFT, padx=(5, 0))
+            ttk.Label(size_grid, text="Масштаб клавиш:").grid(row=1, column=0, sticky="w", pady=(10, 0))
+            scale_frame = ttk.Frame(size_grid)
+            scale_frame.grid(row=1, column=1, columnspan=3, sticky="ew", padx=(10, 0), pady=(10, 0))
+            ttk.Scale(scale_frame, variable=scale_var, from_=0.3, to=2.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(scale_frame, textvariable=scale_var, width=6).pack(side=tk.LEFT, padx=(5, 0))
 
-        # Прозрачность
-        lf_alpha = ttk.Labelframe(tab_main, text="Прозрачность", padding=10)
-        lf_alpha.pack(fill=tk.X, pady=(0, 10))
+            # Прозрачность
+            lf_alpha = ttk.Labelframe(tab_main, text="Прозрачность", padding=10)
+            lf_alpha.pack(fill=tk.X, pady=(0, 10))
 
-        alpha_grid = ttk.Frame(lf_alpha)
-        alpha_grid.pack(fill=tk.X)
+            alpha_grid = ttk.Frame(lf_alpha)
+            alpha_grid.pack(fill=tk.X)
 
-        ttk.Label(alpha_grid, text="Активная:").grid(row=0, column=0, sticky="w")
-        alpha_frame1 = ttk.Frame(alpha_grid)
-        alpha_frame1.grid(row=0, column=1, sticky="ew", padx=(10, 0))
-        ttk.Scale(alpha_frame1, variable=max_alpha_var, from_=0.2, to=1.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(alpha_frame1, textvariable=max_alpha_var, width=6).pack(side=tk.LEFT, padx=(5, 0))
+            ttk.Label(alpha_grid, text="Активная:").grid(row=0, column=0, sticky="w")
+            alpha_frame1 = ttk.Frame(alpha_grid)
+            alpha_frame1.grid(row=0, column=1, sticky="ew", padx=(10, 0))
+            ttk.Scale(alpha_frame1, variable=max_alpha_var, from_=0.2, to=1.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(alpha_frame1, textvariable=max_alpha_var, width=6).pack(side=tk.LEFT, padx=(5, 0))
 
-        ttk.Label(alpha_grid, text="В простое:").grid(row=1, column=0, sticky="w", pady=(8, 0))
-        alpha_frame2 = ttk.Frame(alpha_grid)
-        alpha_frame2.grid(row=1, column=1, sticky="ew", padx=(10, 0), pady=(8, 0))
-        ttk.Scale(alpha_frame2, variable=min_alpha_var, from_=0.05, to=1.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(alpha_frame2, textvariable=min_alpha_var, width=6).pack(side=tk.LEFT, padx=(5, 0))
+            ttk.Label(alpha_grid, text="В простое:").grid(row=1, column=0, sticky="w", pady=(8, 0))
+            alpha_frame2 = ttk.Frame(alpha_grid)
+            alpha_frame2.grid(row=1, column=1, sticky="ew", padx=(10, 0), pady=(8, 0))
+            ttk.Scale(alpha_frame2, variable=min_alpha_var, from_=0.05, to=1.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(alpha_frame2, textvariable=min_alpha_var, width=6).pack(side=tk.LEFT, padx=(5, 0))
 
-        alpha_grid.columnconfigure(1, weight=1)
+            alpha_grid.columnconfigure(1, weight=1)
 
-        # Тайминги
-        lf_time = ttk.Labelframe(tab_main, text="Тайминги", padding=10)
-        lf_time.pack(fill=tk.X)
+            # Тайминги
+            lf_time = ttk.Labelframe(tab_main, text="Тайминги", padding=10)
+            lf_time.pack(fill=tk.X)
 
-        time_grid = ttk.Frame(lf_time)
-        time_grid.pack(fill=tk.X)
+            time_grid = ttk.Frame(lf_time)
+            time_grid.pack(fill=tk.X)
 
-        ttk.Label(time_grid, text="Переход в простой (сек):").grid(row=0, column=0, sticky="w")
-        time_frame1 = ttk.Frame(time_grid)
-        time_frame1.grid(row=0, column=1, sticky="ew", padx=(10, 0))
-        ttk.Scale(time_frame1, variable=idle_timeout_var, from_=0.0, to=30.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Entry(time_frame1, textvariable=idle_timeout_var, width=8).pack(side=tk.LEFT, padx=(5, 0))
+            ttk.Label(time_grid, text="Переход в простой (сек):").grid(row=0, column=0, sticky="w")
+            time_frame1 = ttk.Frame(time_grid)
+            time_frame1.grid(row=0, column=1, sticky="ew", padx=(10, 0))
+            ttk.Scale(time_frame1, variable=idle_timeout_var, from_=0.0, to=30.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Entry(time_frame1, textvariable=idle_timeout_var, width=8).pack(side=tk.LEFT, padx=(5, 0))
 
-        ttk.Label(time_grid, text="Затухание клавиш (сек):").grid(row=1, column=0, sticky="w", pady=(8, 0))
-        time_frame2 = ttk.Frame(time_grid)
-        time_frame2.grid(row=1, column=1, sticky="ew", padx=(10, 0), pady=(8, 0))
-        ttk.Scale(time_frame2, variable=key_fade_duration_var, from_=0.05, to=3.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Entry(time_frame2, textvariable=key_fade_duration_var, width=8).pack(side=tk.LEFT, padx=(5, 0))
+            ttk.Label(time_grid, text="Затухание клавиш (сек):").grid(row=1, column=0, sticky="w", pady=(8, 0))
+            time_frame2 = ttk.Frame(time_grid)
+            time_frame2.grid(row=1, column=1, sticky="ew", padx=(10, 0), pady=(8, 0))
+            ttk.Scale(time_frame2, variable=key_fade_duration_var, from_=0.05, to=3.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Entry(time_frame2, textvariable=key_fade_duration_var, width=8).pack(side=tk.LEFT, padx=(5, 0))
 
-        time_grid.columnconfigure(1, weight=1)
+            ttk.Label(time_grid, text="Частота кадров (FPS):").grid(row=2, column=0, sticky="w", pady=(8, 0))
+            ttk.Combobox(time_grid, textvariable=target_fps_var, values=["30", "60", "120", "144"],
+                         width=8).grid(row=2, column=1, sticky="w", padx=(10, 0), pady=(8, 0))
+
+            ttk.Label(time_grid, text="Кривая затухания:").grid(row=3, column=0, sticky="w", pady=(8, 0))
+            ttk.Combobox(time_grid, textvariable=key_fade_easing_var, values=list(self.FADE_EASINGS),
+                         state="readonly", width=12).grid(row=3, column=1, sticky="w", padx=(10, 0), pady=(8, 0))
+
+            time_grid.columnconfigure(1, weight=1)
 
         # ==================== Вкладка 2: Стиль ====================
-        tab_style = ttk.Frame(notebook, padding=15)
-        notebook.add(tab_style, text="🎨 Стиль клавиш")
-
-        style_var = tk.StringVar(value=self.key_style)
-        border_radius_var = tk.IntVar(value=int(self.border_radius))
-        shadow_size_var = tk.IntVar(value=int(self.shadow_size))
-        glow_intensity_var = tk.DoubleVar(value=float(self.glow_intensity))
-        border_width_var = tk.IntVar(value=int(self.border_width))
-        key_padding_var = tk.IntVar(value=int(self.key_padding))
-
-        # Выбор стиля
-        lf_style = ttk.Labelframe(tab_style, text="Стиль клавиш", padding=15)
-        lf_style.pack(fill=tk.X, pady=(0, 10))
-
-        style_desc = {
-            'flat': '⬜ Плоский — минималистичный дизайн без эффектов',
-            'rounded': '🔘 Скруглённый — мягкие углы и тени',
-            '3d': '📦 3D — объёмный эффект с подсветкой',
-            'glass': '🪟 Стеклянный — прозрачность и отблески'
-        }
+        def build_style_tab(tab_style):
+            style_var = ui['key_style'] = tk.StringVar(value=self.key_style)
+            border_radius_var = ui['border_radius'] = tk.IntVar(value=int(self.border_radius))
+            shadow_size_var = ui['shadow_size'] = tk.IntVar(value=int(self.shadow_size))
+            glow_intensity_var = ui['glow_intensity'] = tk.DoubleVar(value=float(self.glow_intensity))
+            border_width_var = ui['border_width'] = tk.IntVar(value=int(self.border_width))
+            key_padding_var = ui['key_padding'] = tk.IntVar(value=int(self.key_padding))
+            sprites_var = ui['sprites'] = tk.BooleanVar(value=self.render_backend == 'sprites')
+            display_mode_var = ui['display_mode'] = tk.StringVar(value=self.display_mode)
+            heatmap_window_var = ui['heatmap_window'] = tk.StringVar(value=f"{self.heatmap_window:g}")
+
+            # Выбор стиля
+            lf_style = ttk.Labelframe(tab_style, text="Стиль клавиш", padding=15)
+            lf_style.pack(fill=tk.X, pady=(0, 10))
+
+            style_desc = {
+                'flat': '⬜ Плоский — минималистичный дизайн без эффектов',
+                'rounded': '🔘 Скруглённый — мягкие углы и тени',
+                '3d': '📦 3D — объёмный эффект с подсветкой',
+                'glass': '🪟 Стеклянный — прозрачность и отблески'
+            }
+
+            for i, (style_id, desc) in enumerate(style_desc.items()):
+                rb = ttk.Radiobutton(lf_style, text=desc, variable=style_var, value=style_id)
+                rb.pack(anchor='w', pady=3)
+
+            # Настройки красивости
+            lf_beauty = ttk.Labelframe(tab_style, text="Параметры оформления", padding=15)
+            lf_beauty.pack(fill=tk.BOTH, expand=True)
+
+            beauty_grid = ttk.Frame(lf_beauty)
+            beauty_grid.pack(fill=tk.BOTH, expand=True)
+
+            # Скругление
+            ttk.Label(beauty_grid, text="🔵 Скругление углов:").grid(row=0, column=0, sticky="w")
+            radius_frame = ttk.Frame(beauty_grid)
+            radius_frame.grid(row=0, column=1, sticky="ew", padx=(15, 0), pady=5)
+            ttk.Scale(radius_frame, variable=border_radius_var, from_=0, to=25, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(radius_frame, textvariable=border_radius_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
 
-        for i, (style_id, desc) in enumerate(style_desc.items()):
-            rb = ttk.Radiobutton(lf_style, text=desc, variable=style_var, value=style_id)
-            rb.pack(anchor='w', pady=3)
-
-        # Настройки красивости
-        lf_beauty = ttk.Labelframe(tab_style, text="Параметры оформления", padding=15)
-        lf_beauty.pack(fill=tk.BOTH, expand=True)
-
-        beauty_grid = ttk.Frame(lf_beauty)
-        beauty_grid.pack(fill=tk.BOTH, expand=True)
-
-        # Скругление
-        ttk.Label(beauty_grid, text="🔵 Скругление углов:").grid(row=0, column=0, sticky="w")
-        radius_frame = ttk.Frame(beauty_grid)
-        radius_frame.grid(row=0, column=1, sticky="ew", padx=(15, 0), pady=5)
-        ttk.Scale(radius_frame, variable=border_radius_var, from_=0, to=25, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(radius_frame, textvariable=border_radius_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
-
-        # Тень
-        ttk.Label(beauty_grid, text="🌑 Размер тени:").grid(row=1, column=0, sticky="w")
-        shadow_frame = ttk.Frame(beauty_grid)
-        shadow_frame.grid(row=1, column=1, sticky="ew", padx=(15, 0), pady=5)
-        ttk.Scale(shadow_frame, variable=shadow_size_var, from_=0, to=15, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(shadow_frame, textvariable=shadow_size_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
-
-        # Свечение
-        ttk.Label(beauty_grid, text="✨ Интенсивность свечения:").grid(row=2, column=0, sticky="w")
-        glow_frame = ttk.Frame(beauty_grid)
-        glow_frame.grid(row=2, column=1, sticky="ew", padx=(15, 0), pady=5)
-        ttk.Scale(glow_frame, variable=glow_intensity_var, from_=0.0, to=3.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(glow_frame, textvariable=glow_intensity_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
-
-        # Толщина границы
-        ttk.Label(beauty_grid, text="📏 Толщина границы:").grid(row=3, column=0, sticky="w")
-        border_frame = ttk.Frame(beauty_grid)
-        border_frame.grid(row=3, column=1, sticky="ew", padx=(15, 0), pady=5)
-        ttk.Scale(border_frame, variable=border_width_var, from_=0, to=8, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(border_frame, textvariable=border_width_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
-
-        # Отступ клавиш
-        ttk.Label(beauty_grid, text="↔️ Отступ между клавишами:").grid(row=4, column=0, sticky="w")
-        padding_frame = ttk.Frame(beauty_grid)
-        padding_frame.grid(row=4, column=1, sticky="ew", padx=(15, 0), pady=5)
-        ttk.Scale(padding_frame, variable=key_padding_var, from_=0, to=20, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
-        ttk.Label(padding_frame, textvariable=key_padding_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
-
-        beauty_grid.columnconfigure(1, weight=1)
+            # Тень
+            ttk.Label(beauty_grid, text="🌑 Размер тени:").grid(row=1, column=0, sticky="w")
+            shadow_frame = ttk.Frame(beauty_grid)
+            shadow_frame.grid(row=1, column=1, sticky="ew", padx=(15, 0), pady=5)
+            ttk.Scale(shadow_frame, variable=shadow_size_var, from_=0, to=15, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(shadow_frame, textvariable=shadow_size_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
+
+            # Свечение
+            ttk.Label(beauty_grid, text="✨ Интенсивность свечения:").grid(row=2, column=0, sticky="w")
+            glow_frame = ttk.Frame(beauty_grid)
+            glow_frame.grid(row=2, column=1, sticky="ew", padx=(15, 0), pady=5)
+            ttk.Scale(glow_frame, variable=glow_intensity_var, from_=0.0, to=3.0, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(glow_frame, textvariable=glow_intensity_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
+
+            # Толщина границы
+            ttk.Label(beauty_grid, text="📏 Толщина границы:").grid(row=3, column=0, sticky="w")
+            border_frame = ttk.Frame(beauty_grid)
+            border_frame.grid(row=3, column=1, sticky="ew", padx=(15, 0), pady=5)
+            ttk.Scale(border_frame, variable=border_width_var, from_=0, to=8, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(border_frame, textvariable=border_width_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
+
+            # Отступ клавиш
+            ttk.Label(beauty_grid, text="↔️ Отступ между клавишами:").grid(row=4, column=0, sticky="w")
+            padding_frame = ttk.Frame(beauty_grid)
+            padding_frame.grid(row=4, column=1, sticky="ew", padx=(15, 0), pady=5)
+            ttk.Scale(padding_frame, variable=key_padding_var, from_=0, to=20, orient="horizontal").pack(side=tk.LEFT, fill=tk.X, expand=True)
+            ttk.Label(padding_frame, textvariable=key_padding_var, width=4).pack(side=tk.LEFT, padx=(5, 0))
+
+            beauty_grid.columnconfigure(1, weight=1)
+
+            # Сглаженные спрайты
+            sprites_cb = ttk.Checkbutton(tab_style, text="🖼 Сглаженные клавиши (спрайты Pillow)", variable=sprites_var)
+            sprites_cb.pack(anchor='w', pady=(10, 0))
+            if not _load_pil() or ImageTk is None:
+                sprites_cb.state(['disabled'])
+
+            # Режим отображения
+            lf_mode = ttk.Labelframe(tab_style, text="Режим отображения", padding=10)
+            lf_mode.pack(fill=tk.X, pady=(10, 0))
+            ttk.Radiobutton(lf_mode, text="⌨️ Обычный — подсветка нажатий",
+                            variable=display_mode_var, value='keys').pack(anchor='w')
+            ttk.Radiobutton(lf_mode, text="🔥 Тепловая карта — частота нажатий и скорость набора",
+                            variable=display_mode_var, value='heatmap').pack(anchor='w')
+            window_frame = ttk.Frame(lf_mode)
+            window_frame.pack(fill=tk.X, pady=(5, 0))
+            ttk.Label(window_frame, text="Окно тепловой карты (сек):").pack(side=tk.LEFT)
+            ttk.Combobox(window_frame, textvariable=heatmap_window_var, values=["60", "600", "3600"],
+                         width=8).pack(side=tk.LEFT, padx=(10, 0))
 
         # ==================== Вкладка 3: Цвета ====================
-        tab_colors = ttk.Frame(notebook, padding=15)
-        notebook.add(tab_colors, text="🎨 Цвета")
-
         color_keys = [
             ('key_bg', '🟫 Фон клавиш'),
             ('key_border', '⬜ Контур клавиш'),
@@ -594,180 +2161,300 @@ class KeyboardOverlay:
             ('key_shadow', '🌑 Тень клавиш'),
             ('key_highlight', '✨ Подсветка (3D/glass)'),
         ]
-        color_vars = {k: tk.StringVar(value=str(self.colors.get(k, ''))) for k, _ in color_keys}
 
-        # Темы
-        lf_themes = ttk.Labelframe(tab_colors, text="Темы", padding=10)
-        lf_themes.pack(fill=tk.X, pady=(0, 10))
+        def build_colors_tab(tab_colors):
+            color_vars = ui['colors'] = {k: tk.StringVar(value=str(self.colors.get(k, ''))) for k, _ in color_keys}
 
-        theme_ids = list(self.themes.keys())
-        theme_var = tk.StringVar(value="")
+            # Темы
+            lf_themes = ttk.Labelframe(tab_colors, text="Темы", padding=10)
+            lf_themes.pack(fill=tk.X, pady=(0, 10))
 
-        def apply_theme_from_var():
-            tid = theme_var.get().strip()
-            if not tid:
-                return
-            theme = self.themes.get(tid) or {}
-            colors = theme.get('colors') if isinstance(theme, dict) else None
-            if isinstance(colors, dict):
-                for k, _ in color_keys:
-                    if k in colors:
-                        color_vars[k].set(colors[k])
-
-        if theme_ids:
-            theme_frame = ttk.Frame(lf_themes)
-            theme_frame.pack(fill=tk.X)
-            ttk.Label(theme_frame, text="Выбрать тему:").pack(side=tk.LEFT)
-            theme_cb = ttk.Combobox(theme_frame, textvariable=theme_var, state="readonly", values=theme_ids, width=20)
-            theme_cb.pack(side=tk.LEFT, padx=(10, 10))
-            ttk.Button(theme_frame, text="Применить тему", command=apply_theme_from_var).pack(side=tk.LEFT)
-        else:
-            ttk.Label(lf_themes, text="Добавьте темы в themes.json").pack()
-
-        # Цвета
-        lf_colors = ttk.Labelframe(tab_colors, text="Настройка цветов", padding=10)
-        lf_colors.pack(fill=tk.BOTH, expand=True)
-
-        def choose_color(key_name):
-            current = color_vars[key_name].get().strip()
-            alpha_prefix = ""
-            rgb = current
-            if current.startswith("#") and len(current) == 9:
-                alpha_prefix = current[:3]
-                rgb = "#" + current[3:]
-            try:
-                picked = colorchooser.askcolor(color=rgb, parent=win)
-                if picked and picked[1]:
-                    new_rgb = picked[1]
-                    if alpha_prefix:
-                        color_vars[key_name].set(alpha_prefix + new_rgb.lstrip("#"))
-                    else:
-                        color_vars[key_name].set(new_rgb)
-            except Exception:
-                pass
-
-        colors_canvas = tk.Canvas(lf_colors, highlightthickness=0)
-        colors_scrollbar = ttk.Scrollbar(lf_colors, orient="vertical", command=colors_canvas.yview)
-        colors_inner = ttk.Frame(colors_canvas)
-
-        colors_inner.bind("<Configure>", lambda e: colors_canvas.configure(scrollregion=colors_canvas.bbox("all")))
-        colors_canvas.create_window((0, 0), window=colors_inner, anchor="nw")
-        colors_canvas.configure(yscrollcommand=colors_scrollbar.set)
-
-        colors_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        colors_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            theme_ids = list(self.themes.keys())
+            theme_var = ui['theme'] = tk.StringVar(value=self.current_theme or "")
 
-        for i, (k, label) in enumerate(color_keys):
-            row_frame = ttk.Frame(colors_inner)
-            row_frame.pack(fill=tk.X, pady=4)
-            ttk.Label(row_frame, text=label, width=28).pack(side=tk.LEFT)
-            entry = ttk.Entry(row_frame, textvariable=color_vars[k], width=14)
-            entry.pack(side=tk.LEFT, padx=(10, 5))
-            ttk.Button(row_frame, text="...", width=3, command=lambda kk=k: choose_color(kk)).pack(side=tk.LEFT)
-
-        # ==================== Вкладка 4: Клавиши ====================
-        tab_keys = ttk.Frame(notebook, padding=15)
-        notebook.add(tab_keys, text="⌨️ Клавиши")
-
-        row_vars = []
-        for i in range(4):
-            val = bool(self.visible_rows[i]) if i < len(self.visible_rows) else True
-            row_vars.append(tk.BooleanVar(value=val))
-
-        # Отображаемые ряды
-        lf_rows = ttk.Labelframe(tab_keys, text="Отображаемые ряды", padding=10)
-        lf_rows.pack(fill=tk.X, pady=(0, 10))
-
-        row_names = [
-            "Ряд 1: ` 1 2 3 4 5 6 7 8 9 0 - =",
-            "Ряд 2: Q W E R T Y U I O P [ ] \\",
-            "Ряд 3: A S D F G H J K L ; '",
-            "Ряд 4: Z X C V B N M , . /"
-        ]
-
-        for i, name in enumerate(row_names):
-            ttk.Checkbutton(lf_rows, text=name, variable=row_vars[i]).pack(anchor='w', pady=2)
+            def apply_theme_from_var():
+                tid = theme_var.get().strip()
+                if tid not in self.theme_palettes:
+                    return
+                # Тема применяется сразу, поля цветов только отражают её (_apply_theme обновит их сам)
+                self._apply_theme(tid)
+
+            if theme_ids:
+                theme_frame = ttk.Frame(lf_themes)
+                theme_frame.pack(fill=tk.X)
+                ttk.Label(theme_frame, text="Выбрать тему:").pack(side=tk.LEFT)
+                theme_cb = ttk.Combobox(theme_frame, textvariable=theme_var, state="readonly", values=theme_ids, width=20)
+                theme_cb.pack(side=tk.LEFT, padx=(10, 10))
+                ttk.Button(theme_frame, text="Применить тему", command=apply_theme_from_var).pack(side=tk.LEFT)
+            else:
+                ttk.Label(lf_themes, text="Добавьте темы в themes.json").pack()
+
+            # Цвета
+            lf_colors = ttk.Labelframe(tab_colors, text="Настройка цветов", padding=10)
+            lf_colors.pack(fill=tk.BOTH, expand=True)
+
+            def choose_color(key_name):
+                current = color_vars[key_name].get().strip()
+                alpha_prefix = ""
+                rgb = current
+                if current.startswith("#") and len(current) == 9:
+                    alpha_prefix = current[:3]
+                    rgb = "#" + current[3:]
+                try:
+                    picked = colorchooser.askcolor(color=rgb, parent=win)
+                    if picked and picked[1]:
+                        new_rgb = picked[1]
+                        if alpha_prefix:
+                            color_vars[key_name].set(alpha_prefix + new_rgb.lstrip("#"))
+                        else:
+                            color_vars[key_name].set(new_rgb)
+                except Exception:
+                    pass
 
-        # Отключение отдельных клавиш
-        lf_disable = ttk.Labelframe(tab_keys, text="Отключить отдельные клавиши", padding=10)
-        lf_disable.pack(fill=tk.BOTH, expand=True)
+            colors_canvas = tk.Canvas(lf_colors, highlightthickness=0)
+            colors_scrollbar = ttk.Scrollbar(lf_colors, orient="vertical", command=colors_canvas.yview)
+            colors_inner = ttk.Frame(colors_canvas)
 
-        ttk.Label(lf_disable, text="Снимите галочки с клавиш, которые не хотите отображать:", 
-                  foreground='gray').pack(anchor='w', pady=(0, 10))
+            colors_inner.bind("<Configure>", lambda e: colors_canvas.configure(scrollregion=colors_canvas.bbox("all")))
+            colors_canvas.create_window((0, 0), window=colors_inner, anchor="nw")
+            colors_canvas.configure(yscrollcommand=colors_scrollbar.set)
 
-        # Создаём словарь переменных для каждой клавиши
-        key_vars = {}  # {"row_0": {"1": BooleanVar, ...}, ...}
+            colors_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+            colors_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
-        keys_notebook = ttk.Notebook(lf_disable)
-        keys_notebook.pack(fill=tk.BOTH, expand=True)
+            for i, (k, label) in enumerate(color_keys):
+                row_frame = ttk.Frame(colors_inner)
+                row_frame.pack(fill=tk.X, pady=4)
+                ttk.Label(row_frame, text=label, width=28).pack(side=tk.LEFT)
+                entry = ttk.Entry(row_frame, textvariable=color_vars[k], width=14)
+                entry.pack(side=tk.LEFT, padx=(10, 5))
+                ttk.Button(row_frame, text="...", width=3, command=lambda kk=k: choose_color(kk)).pack(side=tk.LEFT)
 
-        for row_idx, row in enumerate(self.english_layout):
-            row_tab = ttk.Frame(keys_notebook, padding=10)
-            keys_notebook.add(row_tab, text=f"Ряд {row_idx + 1}")
-            
-            key_vars[f"row_{row_idx}"] = {}
-            disabled_in_row = self.disabled_keys.get(f"row_{row_idx}", [])
-            
-            # Создаём сетку клавиш
-            keys_frame = ttk.Frame(row_tab)
-            keys_frame.pack(fill=tk.BOTH, expand=True)
-            
-            for col_idx, key_char in enumerate(row):
-                is_enabled = key_char not in disabled_in_row
-                var = tk.BooleanVar(value=is_enabled)
-                key_vars[f"row_{row_idx}"][key_char] = var
+        # ==================== Вкладка 4: Клавиши ====================
+        def build_keys_tab(tab_keys):
+            row_vars = ui['visible_rows'] = []
+            for i in range(len(self.base_layout)):
+                val = bool(self.visible_rows[i]) if i < len(self.visible_rows) else True
+                row_vars.append(tk.BooleanVar(value=val))
+
+            # Отображаемые ряды
+            lf_rows = ttk.Labelframe(tab_keys, text="Отображаемые ряды", padding=10)
+            lf_rows.pack(fill=tk.X, pady=(0, 10))
+
+            row_names = [
+                "Ряд 1: ` 1 2 3 4 5 6 7 8 9 0 - =",
+                "Ряд 2: Q W E R T Y U I O P [ ] \\",
+                "Ряд 3: A S D F G H J K L ; '",
+                "Ряд 4: Z X C V B N M , . /",
+                "Ряд 5: Tab Caps Shift Ctrl Alt Space Enter ⌫"
+            ]
+
+            for i, name in enumerate(row_names[:len(row_vars)]):
+                ttk.Checkbutton(lf_rows, text=name, variable=row_vars[i]).pack(anchor='w', pady=2)
+
+            # Отключение отдельных клавиш
+            lf_disable = ttk.Labelframe(tab_keys, text="Отключить отдельные клавиши", padding=10)
+            lf_disable.pack(fill=tk.BOTH, expand=True)
+
+            ttk.Label(lf_disable, text="Снимите галочки с клавиш, которые не хотите отображать:", 
+                      foreground='gray').pack(anchor='w', pady=(0, 10))
+
+            # Словарь переменных для клавиш; ряд попадает сюда, когда его вкладку открыли
+            key_vars = ui['key_vars'] = {}  # {"row_0": {"1": BooleanVar, ...}, ...}
+
+            keys_notebook = ttk.Notebook(lf_disable)
+            keys_notebook.pack(fill=tk.BOTH, expand=True)
+
+            def build_row_tab(row_tab, row_idx):
+                row = self.base_layout[row_idx]
+                key_vars[f"row_{row_idx}"] = {}
+                disabled_in_row = self.disabled_keys.get(f"row_{row_idx}", [])
+                
+                # Создаём сетку клавиш
+                keys_frame = ttk.Frame(row_tab)
+                keys_frame.pack(fill=tk.BOTH, expand=True)
+                
+                for col_idx, key_char in enumerate(row):
+                    is_enabled = key_char not in disabled_in_row
+                    var = tk.BooleanVar(value=is_enabled)
+                    key_vars[f"row_{row_idx}"][key_char] = var
+                    
+                    # Рамка для клавиши
+                    key_frame = ttk.Frame(keys_frame)
+                    key_frame.grid(row=col_idx // 7, column=col_idx % 7, padx=3, pady=3)
+                    
+                    label = self._layout_tables[self.default_layout]['labels'][(row_idx, col_idx)]
+                    cb = ttk.Checkbutton(key_frame, text=label, variable=var, width=max(4, len(label)))
+                    cb.pack()
+
+                # Кнопки управления
+                btn_frame = ttk.Frame(row_tab)
+                btn_frame.pack(fill=tk.X, pady=(10, 0))
                 
-                # Рамка для клавиши
-                key_frame = ttk.Frame(keys_frame)
-                key_frame.grid(row=col_idx // 7, column=col_idx % 7, padx=3, pady=3)
+                def select_all(ridx=row_idx):
+                    for kv in key_vars[f"row_{ridx}"].values():
+                        kv.set(True)
                 
-                cb = ttk.Checkbutton(key_frame, text=key_char.upper(), variable=var, width=4)
-                cb.pack()
+                def deselect_all(ridx=row_idx):
+                    for kv in key_vars[f"row_{ridx}"].values():
+                        kv.set(False)
+                
+                ttk.Button(btn_frame, text="Выбрать все", command=select_all).pack(side=tk.LEFT, padx=(0, 5))
+                ttk.Button(btn_frame, text="Снять все", command=deselect_all).pack(side=tk.LEFT)
+
+            row_tabs = []
+            for row_idx in range(len(self.base_layout)):
+                row_tab = ttk.Frame(keys_notebook, padding=10)
+                keys_notebook.add(row_tab, text=f"Ряд {row_idx + 1}")
+                row_tabs.append((row_tab, lambda tab, ridx=row_idx: build_row_tab(tab, ridx)))
+            self._lazy_notebook(keys_notebook, row_tabs)
+
+        # ==================== Вкладка 5: Производительность ====================
+        def build_perf_tab(tab_perf):
+            perf_enabled_var = tk.BooleanVar(value=self.profiler is not None)
+            perf_text_var = tk.StringVar(value="")
+
+            def toggle_profiling():
+                self._set_profiling(perf_enabled_var.get())
+                refresh_perf()
+
+            ttk.Checkbutton(tab_perf, text="Замерять время фаз кадра", variable=perf_enabled_var,
+                            command=toggle_profiling).pack(anchor='w')
+
+            lf_perf = ttk.Labelframe(tab_perf, text="Время кадра, мс (последние 600 кадров)", padding=10)
+            lf_perf.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+            ttk.Label(lf_perf, textvariable=perf_text_var, font=('Consolas', 10), justify=tk.LEFT).pack(anchor='nw')
+
+            def refresh_perf():
+                header = [self.pacer.report_line(), self.latency.report_line()]
+                if self.profiler is None:
+                    perf_text_var.set("\n".join(header + ["Замер фаз выключен"]))
+                else:
+                    perf_text_var.set("\n".join(header + self.profiler.report_lines()))
 
-            # Кнопки управления
-            btn_frame = ttk.Frame(row_tab)
-            btn_frame.pack(fill=tk.X, pady=(10, 0))
-            
-            def select_all(ridx=row_idx):
-                for kv in key_vars[f"row_{ridx}"].values():
-                    kv.set(True)
-            
-            def deselect_all(ridx=row_idx):
-                for kv in key_vars[f"row_{ridx}"].values():
-                    kv.set(False)
-            
-            ttk.Button(btn_frame, text="Выбрать все", command=select_all).pack(side=tk.LEFT, padx=(0, 5))
-            ttk.Button(btn_frame, text="Снять все", command=deselect_all).pack(side=tk.LEFT)
+            perf_polling = [False]
+
+            def poll_perf(event=None):
+                # Обновляем только пока вкладка видна, иначе таймер не держим
+                if event is not None and perf_polling[0]:
+                    return
+                try:
+                    perf_polling[0] = bool(tab_perf.winfo_ismapped())
+                except Exception:
+                    perf_polling[0] = False
+                if perf_polling[0]:
+                    refresh_perf()
+                    win.after(500, poll_perf)
+
+            def reset_perf():
+                if self.profiler is not None:
+                    self.profiler.reset()
+                self.pacer.reset()
+                refresh_perf()
+
+            perf_btns = ttk.Frame(tab_perf)
+            perf_btns.pack(fill=tk.X, pady=(10, 0))
+            ttk.Button(perf_btns, text="📝 Записать в лог", command=self._log_profile).pack(side=tk.LEFT, padx=(0, 5))
+            ttk.Button(perf_btns, text="Сбросить", command=reset_perf).pack(side=tk.LEFT)
+            refresh_perf()
+            tab_perf.bind('<Map>', poll_perf)
+
+        tabs = []
+        for title, builder in (
+            ("📍 Основные", build_main_tab),
+            ("🎨 Стиль клавиш", build_style_tab),
+            ("🎨 Цвета", build_colors_tab),
+            ("⌨️ Клавиши", build_keys_tab),
+            ("⏱ Производительность", build_perf_tab),
+        ):
+            tab = ttk.Frame(notebook, padding=15)
+            notebook.add(tab, text=title)
+            tabs.append((tab, builder))
+        self._lazy_notebook(notebook, tabs)
 
         # ==================== Кнопки внизу ====================
         btns = ttk.Frame(main_frame)
         btns.pack(fill=tk.X, pady=(12, 0))
 
+        def refresh_settings(names=None):
+            """Переменные окна ← текущие настройки; names — только эти поля конфига (None — все)"""
+            values = {
+                'position': self.position,
+                'width': int(self.width),
+                'height': int(self.height),
+                'scale': float(self.scale),
+                'max_alpha': float(self.max_alpha),
+                'min_alpha': float(self.min_alpha),
+                'idle_timeout': float(self.idle_timeout),
+                'key_fade_duration': float(self.key_fade_duration),
+                'target_fps': f"{self.pacer.target_fps:g}",
+                'key_fade_easing': self.key_fade_easing,
+                'key_style': self.key_style,
+                'border_radius': int(self.border_radius),
+                'shadow_size': int(self.shadow_size),
+                'glow_intensity': float(self.glow_intensity),
+                'border_width': int(self.border_width),
+                'key_padding': int(self.key_padding),
+                'render_backend': self.render_backend == 'sprites',
+                'display_mode': self.display_mode,
+                'heatmap_window': f"{self.heatmap_window:g}",
+                'theme': self.current_theme or "",
+            }
+            var_names = {'render_backend': 'sprites'}  # переменные, названные не как поле конфига
+            for name, value in values.items():
+                var_name = var_names.get(name, name)
+                if var_name in ui and (names is None or name in names):
+                    ui[var_name].set(value)
+            if 'colors' in ui and (names is None or 'colors' in names):
+                for k, var in ui['colors'].items():
+                    var.set(str(self.colors.get(k, '')))
+            if 'visible_rows' in ui and (names is None or 'visible_rows' in names):
+                for i, var in enumerate(ui['visible_rows']):
+                    var.set(bool(self.visible_rows[i]) if i < len(self.visible_rows) else True)
+            if 'key_vars' in ui and (names is None or 'disabled_keys' in names):
+                for row_key, keys_dict in ui['key_vars'].items():
+                    disabled_in_row = self.disabled_keys.get(row_key, [])
+                    for key_char, var in keys_dict.items():
+                        var.set(key_char not in disabled_in_row)
+
+        # Окно только прячется, а apply_settings при закрытии пишет переменные обратно —
+        # они должны отражать правки из config.json и трея, а не значения на момент постройки вкладки
+        self._refresh_settings = refresh_settings
+
         def apply_settings(save=False):
             try:
-                pos = position_var.get().strip()
-                if pos != 'custom':
-                    self.position = pos
-                    self.custom_x = None
-                    self.custom_y = None
-                else:
-                    self.position = 'custom'
-                
-                self.width = int(width_var.get())
-                self.height = int(height_var.get())
-                self.scale = float(scale_var.get())
-                self.max_alpha = float(max_alpha_var.get())
-                self.min_alpha = float(min_alpha_var.get())
-                self.idle_timeout = float(idle_timeout_var.get())
-                self.key_fade_duration = float(key_fade_duration_var.get())
+                if 'position' in ui:
+                    pos = ui['position'].get().strip()
+                    if pos != 'custom':
+                        self.position = pos
+                        self.custom_x = None
+                        self.custom_y = None
+                    else:
+                        self.position = 'custom'
+                    
+                    self.width = int(ui['width'].get())
+                    self.height = int(ui['height'].get())
+                    self.scale = float(ui['scale'].get())
+                    self.max_alpha = float(ui['max_alpha'].get())
+                    self.min_alpha = float(ui['min_alpha'].get())
+                    self.idle_timeout = float(ui['idle_timeout'].get())
+                    self.key_fade_duration = float(ui['key_fade_duration'].get())
+                    self._set_target_fps(float(ui['target_fps'].get()))
+                    self._set_fade_easing(ui['key_fade_easing'].get())
 
                 # Стиль
-                self.key_style = style_var.get()
-                self.border_radius = int(border_radius_var.get())
-                self.shadow_size = int(shadow_size_var.get())
-                self.glow_intensity = float(glow_intensity_var.get())
-                self.border_width = int(border_width_var.get())
-                self.key_padding = int(key_padding_var.get())
+                if 'key_style' in ui:
+                    self.key_style = ui['key_style'].get()
+                    self.border_radius = int(ui['border_radius'].get())
+                    self.shadow_size = int(ui['shadow_size'].get())
+                    self.glow_intensity = float(ui['glow_intensity'].get())
+                    self.border_width = int(ui['border_width'].get())
+                    self.key_padding = int(ui['key_padding'].get())
+                    self.render_backend = 'sprites' if ui['sprites'].get() else 'canvas'
+                    display_mode = ui['display_mode'].get()
+                    heatmap_window = max(1.0, float(ui['heatmap_window'].get()))
+                    if display_mode != self.display_mode or heatmap_window != self.heatmap_window:
+                        self._set_display_mode(display_mode, heatmap_window)
 
                 # sanity
                 self.max_alpha = max(0.05, min(1.0, self.max_alpha))
@@ -777,28 +2464,40 @@ class KeyboardOverlay:
                 self.idle_timeout = max(0.0, float(self.idle_timeout))
                 self.key_fade_duration = max(0.02, float(self.key_fade_duration))
 
-                self.visible_rows = [v.get() for v in row_vars]
-
-                # Собираем отключённые клавиши
-                self.disabled_keys = {}
-                for row_key, keys_dict in key_vars.items():
-                    disabled = []
-                    for key_char, var in keys_dict.items():
-                        if not var.get():
-                            disabled.append(key_char)
-                    if disabled:
-                        self.disabled_keys[row_key] = disabled
-
-                for k, _ in color_keys:
-                    val = color_vars[k].get().strip()
-                    if val:
-                        self.colors[k] = val
+                if 'visible_rows' in ui:
+                    self.visible_rows = [v.get() for v in ui['visible_rows']]
+
+                    # Собираем отключённые клавиши (ряды, которые не открывали, не меняются)
+                    disabled_keys = dict(self.disabled_keys)
+                    for row_key, keys_dict in ui['key_vars'].items():
+                        disabled = []
+                        for key_char, var in keys_dict.items():
+                            if not var.get():
+                                disabled.append(key_char)
+                        if disabled:
+                            disabled_keys[row_key] = disabled
+                        else:
+                            disabled_keys.pop(row_key, None)
+                    self.disabled_keys = disabled_keys
+
+                if 'colors' in ui:
+                    old_colors = dict(self.colors)
+                    for k, _ in color_keys:
+                        val = ui['colors'][k].get().strip()
+                        if val:
+                            self.colors[k] = val
+                    if self.colors != old_colors:
+                        self.current_theme = None
+                        self._theme_fade = None
+                        self._sprite_prerender = None
+                        self._palette = self._compile_palette(self.colors)
 
                 self._apply_geometry()
+                self._invalidate_geometry()
+                self._request_animation()
                 self.current_alpha = min(self.current_alpha, self.max_alpha)
                 self.target_alpha = min(self.target_alpha, self.max_alpha)
-                if platform.system() == 'Windows':
-                    self.root.attributes('-alpha', self.current_alpha)
+                self.window_state.set_alpha(self.current_alpha)
 
                 if save:
                     self._save_config()
@@ -820,11 +2519,27 @@ class KeyboardOverlay:
         if not show:
             win.withdraw()
 
+    def _lazy_notebook(self, notebook, tabs):
+        """Строит содержимое вкладки notebook при первом её выборе; tabs: [(frame, builder)]"""
+        pending = {str(frame): (frame, builder) for frame, builder in tabs}
+
+        def build_selected(event=None):
+            selected = notebook.select()
+            if selected in pending:
+                frame, builder = pending.pop(selected)
+                builder(frame)
+
+        notebook.bind('<<NotebookTabChanged>>', build_selected, add='+')
+        build_selected()
+
     def _show_settings(self):
         if not self.settings_window:
             self._create_settings_window(show=True)
             return
         try:
+            if self.settings_window.state() == 'withdrawn' and self._refresh_settings:
+                # Пока окно было скрыто, настройки могли поменяться (config.json, трей)
+                self._refresh_settings()
             self.settings_window.deiconify()
             self.settings_window.lift()
             self.settings_window.focus_force()
@@ -836,18 +2551,30 @@ class KeyboardOverlay:
             if self.root.state() == 'withdrawn':
                 self.root.deiconify()
                 self.root.lift()
+                self._overlay_hidden = False
+                self._request_animation()
             else:
                 self.root.withdraw()
+                self._overlay_hidden = True
         except Exception:
             try:
                 self.root.withdraw()
+                self._overlay_hidden = True
             except Exception:
                 pass
 
-    def _quit(self):
-        """Корректный выход"""
+    def _quit(self, save=True):
+        """Корректный выход; save=False — без записи config.json (служебные режимы --replay и т.п.)"""
+        self._closing = True
         try:
-            self._save_config()
+            self.stop_recording()
+        except Exception:
+            pass
+        try:
+            if save:
+                self._save_config()
+            if not self.config_store.flush(timeout=2.0):
+                self._log("Config save: flush timed out on exit", 'WARNING')
         except Exception:
             pass
         try:
@@ -855,6 +2582,15 @@ class KeyboardOverlay:
                 self.listener.stop()
         except Exception:
             pass
+        try:
+            self.layout_watcher.stop()
+            self.file_watcher.stop()
+        except Exception:
+            pass
+        try:
+            self.logger.close(timeout=1.0)
+        except Exception:
+            pass
         try:
             if self.tray_icon:
                 self.tray_icon.stop()
@@ -865,19 +2601,56 @@ class KeyboardOverlay:
         except Exception:
             pass
 
+    def _build_tray_menu(self):
+        """Меню трея (pystray уже загружен); пункты вызываются из потока трея"""
+        def post_to_tk(fn):
+            self.root.after(0, fn)
+
+        def theme_item(theme_id, theme):
+            # pystray передаёт (icon, item) по числу аргументов — тему замыкаем снаружи
+            return pystray.MenuItem(
+                theme['name'],
+                lambda: post_to_tk(lambda: self._apply_theme(theme_id)),
+                checked=lambda item: self.current_theme == theme_id,
+                radio=True,
+            )
+
+        menu_items = [pystray.MenuItem("Настройки", lambda: post_to_tk(self._show_settings))]
+        if self.themes:
+            menu_items.append(pystray.MenuItem("Тема", pystray.Menu(
+                *[theme_item(tid, theme) for tid, theme in self.themes.items()]
+            )))
+        menu_items.append(pystray.MenuItem("Выход", lambda: post_to_tk(self._quit)))
+        return pystray.Menu(*menu_items)
+
+    def _update_tray_menu(self):
+        """Пересобрать меню трея (изменился список тем)"""
+        if self.tray_icon is None:
+            return
+        try:
+            self.tray_icon.menu = self._build_tray_menu()
+            self.tray_icon.update_menu()
+        except Exception as e:
+            self._log(f"Tray: menu update failed: {e!r}", 'WARNING')
+
     def _setup_tray(self):
-        """Иконка в трее + меню (если доступны зависимости)"""
-        if self.tray_icon is not None:
+        """Иконка в трее + меню (если доступны зависимости); вся подготовка — в фоновом потоке"""
+        if self.tray_icon is not None or self.tray_thread is not None:
             return
 
         self._log("Tray setup: start")
-        if pystray is None or Image is None:
-            self._log("Tray setup: pystray/PIL not available; tray disabled")
+
+        def set_status(text):
+            # StringVar трогаем только из потока Tk
+            def apply():
+                try:
+                    self.tray_status_var.set(text)
+                except Exception:
+                    pass
             try:
-                self.tray_status_var.set("Трей: недоступен (нет pystray/Pillow)")
+                self.root.after(0, apply)
             except Exception:
                 pass
-            return
 
         def ensure_icon_file(path):
             try:
@@ -910,30 +2683,29 @@ class KeyboardOverlay:
                 draw.text((24, 18), "K", fill=(0, 0, 0, 255))
                 return img
 
-        def post_to_tk(fn):
-            self.root.after(0, fn)
-
-        menu = pystray.Menu(
-            pystray.MenuItem("Настройки", lambda: post_to_tk(self._show_settings)),
-            pystray.MenuItem("Выход", lambda: post_to_tk(self._quit)),
-        )
+        def run_tray():
+            started = time.perf_counter()
+            if _load_pystray() is None or not _load_pil():
+                self._log("Tray setup: pystray/PIL not available; tray disabled")
+                set_status("Трей: недоступен (нет pystray/Pillow)")
+                return
 
-        icon_path = str(self.tray_icon_path or 'tray.ico')
-        ensure_icon_file(icon_path)
-        icon_image = load_image_from_file(icon_path)
-        try:
-            icon_image = icon_image.convert('RGBA')
-        except Exception:
-            pass
+            menu = self._build_tray_menu()
 
-        self.tray_icon = pystray.Icon("keyboard_overlay", icon_image, "Keyboard Overlay", menu)
-        try:
-            self.tray_status_var.set("Трей: запускается...")
-        except Exception:
-            pass
+            icon_path = str(self.tray_icon_path or 'tray.ico')
+            ensure_icon_file(icon_path)
+            icon_image = load_image_from_file(icon_path)
+            try:
+                icon_image = icon_image.convert('RGBA')
+            except Exception:
+                pass
 
-        def run_tray():
+            if self._closing:
+                return
             try:
+                self.tray_icon = pystray.Icon("keyboard_overlay", icon_image, "Keyboard Overlay", menu)
+                self.startup_phases.append(('tray (фон)', (time.perf_counter() - started) * 1000))
+                set_status("Трей: запускается...")
                 self._log("Tray thread: run() begin")
                 self.tray_icon.run()
                 self._log("Tray thread: run() finished")
@@ -949,18 +2721,20 @@ class KeyboardOverlay:
                     ))
                 except Exception:
                     pass
-                try:
-                    self.tray_status_var.set("Трей: ошибка (см. keyboard_overlay.log)")
-                except Exception:
-                    pass
+                set_status("Трей: ошибка (см. keyboard_overlay.log)")
 
         self.tray_thread = threading.Thread(target=run_tray, daemon=False)
         self.tray_thread.start()
 
         def post_check():
+            if self.tray_thread is not None and self.tray_thread.is_alive() and self.tray_icon is None:
+                # Поток ещё готовит иконку — проверим позже
+                self.root.after(1000, post_check)
+                return
             if self.tray_icon is None:
                 try:
-                    self.tray_status_var.set("Трей: не запущен (см. keyboard_overlay.log)")
+                    if not self.tray_status_var.get().startswith("Трей: недоступен"):
+                        self.tray_status_var.set("Трей: не запущен (см. keyboard_overlay.log)")
                 except Exception:
                     pass
             else:
@@ -972,55 +2746,136 @@ class KeyboardOverlay:
 
         self.root.after(1000, post_check)
     
-    def _detect_windows_layout(self):
-        """Определение раскладки из Windows"""
+    def _create_layout_backend(self):
+        """Источник раскладки: user32 на Windows, подменный на остальных системах"""
         if platform.system() == 'Windows':
             try:
-                user32 = ctypes.WinDLL('user32', use_last_error=True)
-                hwnd = user32.GetForegroundWindow()
-                thread_id = user32.GetWindowThreadProcessId(hwnd, 0)
-                klid = user32.GetKeyboardLayout(thread_id)
-                lid = klid & 0xFFFF
-                
-                if lid == 0x0419:
-                    return 'ru'
-                else:
-                    return 'en'
-            except:
+                return Win32LayoutBackend()
+            except Exception:
                 pass
-        return 'en'
+        return FakeLayoutBackend()
+    
+    def _on_layout_change(self, layout):
+        """Смена раскладки (вызывается из потока LayoutWatcher)"""
+        try:
+            self.root.after(0, lambda: self._apply_display_layout(layout))
+        except Exception:
+            pass
+    
+    def _apply_display_layout(self, layout):
+        """Переключить отображаемую раскладку (поток Tk)"""
+        if layout != self.current_display_layout and layout in self._layout_tables:
+            self.current_display_layout = layout
+            self._char_to_key = self._layout_tables[layout]['char_to_key']
+            self._invalidate_scene()
+            self._request_animation()
+    
+    def start_recording(self, path):
+        """Писать все нажатия в бинарный лог (см. KeystrokeRecorder)"""
+        self.stop_recording()
+        self.recorder = KeystrokeRecorder(path, self.layouts, len(self._key_ids))
+        self._log(f"Recording keystrokes to {path}")
+    
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self._log(f"Recording stopped: {self.recorder.count} events")
+            self.recorder = None
     
     def _on_key_press(self, key):
-        """Обработка нажатия клавиши"""
+        """Обработка нажатия клавиши (поток pynput): только кладём событие в очередь"""
         try:
-            # Обновляем раскладку для отображения (без очистки pressed_keys)
-            new_layout = self._detect_windows_layout()
-            if new_layout != self.current_display_layout:
-                self.current_display_layout = new_layout
-            
-            if hasattr(key, 'char') and key.char:
-                char = key.char.lower()
-                current_time = time.time()
+            key_id = self._resolve_key(key)
+            char = getattr(key, 'char', None) or ''
+            if key_id is not None or char:
+                self._input_events.put((time.monotonic(), key_id, char, time.perf_counter()))
                 
-                # Добавляем сам символ
-                self.pressed_keys[char] = (current_time, 1.0)
-                
-                # Также добавляем эквивалент на другой раскладке для надёжности
-                # Это помогает когда pynput возвращает символы не той раскладки
-                if char in self.ru_to_en_map:
-                    # Это русский символ, добавляем английский эквивалент
-                    en_char = self.ru_to_en_map[char]
-                    self.pressed_keys[en_char] = (current_time, 1.0)
-                elif char in self.en_to_ru_map:
-                    # Это английский символ, добавляем русский эквивалент
-                    ru_char = self.en_to_ru_map[char]
-                    self.pressed_keys[ru_char] = (current_time, 1.0)
-                
-                self.last_activity_time = current_time
-                self.target_alpha = self.max_alpha
+                # Будим цикл анимации, только если он уснул (один вызов Tk на период сна);
+                # пока цикл не спит, очередь забирает _poll_input в потоке Tk
+                if self._wake_on_input:
+                    self._wake_on_input = False
+                    self.root.after(0, self._redraw_input if self.immediate_redraw else self._request_animation)
         except:
             pass
     
+    def _resolve_key(self, key):
+        """id физической клавиши по коду из pynput; None — определять по символу"""
+        # Скан-код (pynput на Windows) не зависит от раскладки
+        scan = getattr(key, '_scan', None)
+        if isinstance(scan, int) and scan in self._scan_to_key:
+            return self._scan_to_key[scan]
+        # pynput.Key (space, shift, ...) — перечисление с именем
+        name = getattr(key, 'name', None)
+        if isinstance(name, str):
+            return self._special_to_key.get(name)
+        vk = getattr(key, 'vk', None)
+        if isinstance(vk, int):
+            return self._vk_to_key.get(vk)
+        return None
+    
+    def _redraw_input(self):
+        """Сразу после нажатия (поток Tk): перерисовать только нажатые клавиши, не ждать кадра"""
+        if self._overlay_hidden:
+            return
+        if not self._scene_dirty:
+            pressed = self._drain_input_events()
+            if pressed:
+                self._draw_keyboard(pressed)
+        # Затухание дальше ведёт обычный цикл анимации
+        self._request_animation()
+    
+    def _poll_input(self):
+        """Проверка очереди нажатий между кадрами (поток Tk, каждые INPUT_POLL_MS, пока цикл не спит)"""
+        self._input_poll_job = None
+        if self._wake_on_input or self._overlay_hidden or not self.immediate_redraw:
+            return  # цикл уснул — следующее нажатие разбудит его из хука
+        if not self._input_events.empty():
+            self._redraw_input()
+        self._input_poll_job = self.root.after(self.INPUT_POLL_MS, self._poll_input)
+    
+    def _drain_input_events(self):
+        """Забирает все накопившиеся нажатия одной пачкой (поток Tk); возвращает id нажатых клавиш"""
+        events = self._input_events
+        char_to_key = self._char_to_key
+        press_times = self._press_times
+        press_alpha = self._press_alpha
+        active = self._active_keys
+        recorder = self.recorder
+        heatmap = self.heatmap
+        latency_pending = self._latency_pending
+        pressed = []
+        last_time = None
+        count = 0
+        while True:
+            try:
+                press_time, key_id, char, hook_time = events.get_nowait()
+            except queue.Empty:
+                break
+            
+            # Без кода клавиши — по символу (индекс текущей раскладки)
+            char = char.lower()
+            if key_id is None:
+                key_id = char_to_key.get(char)
+            if key_id is not None:
+                if press_alpha[key_id] <= 0.0:
+                    active.append(key_id)
+                press_times[key_id] = press_time
+                press_alpha[key_id] = 1.0
+                pressed.append(key_id)
+                latency_pending.append(hook_time)
+            heatmap.add(key_id, press_time)
+            if recorder is not None:
+                recorder.write(press_time, char, key_id, self.current_display_layout)
+            last_time = press_time
+            count += 1
+        
+        if last_time is not None:
+            self.last_activity_time = max(self.last_activity_time, last_time)
+            self.target_alpha = self.max_alpha
+            if self.logger.enabled_for('DEBUG'):
+                self.logger.debug(f"Input: drained {count} events")
+        return pressed
+    
     def _on_key_release(self, key):
         """Обработка отпускания"""
         pass
@@ -1028,23 +2883,75 @@ class KeyboardOverlay:
     def _start_key_listener(self):
         """Запуск listener"""
         def start():
+            started = time.perf_counter()
+            try:
+                from pynput import keyboard
+            except Exception as e:
+                self._log(f"Listener: pynput not available: {e!r}", 'ERROR')
+                return
             self.listener = keyboard.Listener(
                 on_press=self._on_key_press,
                 on_release=self._on_key_release
             )
             self.listener.start()
+            self.startup_phases.append(('listener_thread (фон)', (time.perf_counter() - started) * 1000))
         
-        thread = threading.Thread(target=start, daemon=True)
-        thread.start()
+        self.listener_thread = threading.Thread(target=start, daemon=True)
+        self.listener_thread.start()
     
-    def _draw_keyboard(self):
-        """Отрисовка клавиатуры"""
-        self.canvas.delete("all")
-        
-        if self.current_display_layout == 'ru':
-            layout = self.russian_layout
-        else:
-            layout = self.english_layout
+    def _invalidate_scene(self):
+        """Пометить сцену для пересоздания (раскладка изменилась)"""
+        self._scene_dirty = True
+
+    def _invalidate_geometry(self):
+        """Сбросить кэш геометрии (изменились настройки) и пересоздать сцену"""
+        self._geometry_cache.clear()
+        self._sprite_atlas.clear()
+        self._scene_dirty = True
+        if self._sprite_prerender is not None:
+            # Спрайты рисовались под старую геометрию; сцена всё равно пересоздаётся — палитру ставим сразу
+            self._palette = self._sprite_prerender[1]
+            self._sprite_prerender = None
+
+    def _geometry_key(self):
+        """Параметры, от которых зависит геометрия клавиатуры"""
+        return (
+            self.current_display_layout,
+            self.scale,
+            self.key_padding,
+            self.border_radius,
+            self.width,
+            self.key_style,
+            self.shadow_size,
+            tuple(bool(v) for v in self.visible_rows),
+            tuple(sorted((row, tuple(keys)) for row, keys in self.disabled_keys.items())),
+        )
+
+    def _get_geometry(self):
+        """Геометрия клавиатуры из кэша (считается один раз на набор параметров)"""
+        cache_key = self._geometry_key()
+        geometry = self._geometry_cache.get(cache_key)
+        if geometry is None:
+            geometry = self._compute_geometry()
+            self._geometry_cache[cache_key] = geometry
+        return geometry
+
+    def _compute_geometry(self):
+        """Считает прямоугольники, точки полигонов и маску отключённых клавиш"""
+        table = self._layout_tables[self.current_display_layout]
+        layout = table['rows']
+        labels = table['labels']
+        key_ids = self._key_ids
+
+        # Маска отключённых клавиш: бит col_idx в ряду row_idx
+        disabled_mask = []
+        for row_idx, row in enumerate(self.base_layout):
+            disabled_in_row = self.disabled_keys.get(f"row_{row_idx}", [])
+            mask = 0
+            for col_idx, en_char in enumerate(row):
+                if en_char in disabled_in_row:
+                    mask |= 1 << col_idx
+            disabled_mask.append(mask)
 
         visible = []
         for row_idx, row in enumerate(layout):
@@ -1052,225 +2959,388 @@ class KeyboardOverlay:
                 continue
             visible.append((row_idx, row))
         if not visible:
-            return
+            return {'keys': [], 'disabled_mask': disabled_mask}
         
         key_width = 50 * self.scale
         key_height = 50 * self.scale
         key_spacing = self.key_padding * self.scale
+        row_offsets = [0, key_width * 0.25, key_width * 0.5, key_width * 0.75]
+        key_units = self._key_units  # ширина служебных клавиш в обычных клавишах
+        
+        def key_span(char):
+            units = key_units.get(char, 1.0)
+            return key_width * units + key_spacing * (units - 1)
         
         max_row_width = 0
         for row_idx, row in visible:
-            offset = 0
-            if row_idx == 1:
-                offset = key_width * 0.25
-            elif row_idx == 2:
-                offset = key_width * 0.5
-            elif row_idx == 3:
-                offset = key_width * 0.75
-            
-            row_width = len(row) * (key_width + key_spacing) - key_spacing + offset
+            offset = row_offsets[row_idx] if row_idx < len(row_offsets) else 0
+            row_width = sum(key_span(char) + key_spacing for char in row) - key_spacing + offset
             max_row_width = max(max_row_width, row_width)
         
         start_x = (self.width - max_row_width) // 2
         start_y = 20
         
+        radius = self.border_radius * self.scale
+        shadow_size = self.shadow_size * self.scale
+        depth = 4 * self.scale
+        points = self._rounded_rect_points
+        h = key_height
+        
+        keys = []
         for display_row_idx, (row_idx, row) in enumerate(visible):
-            offset = 0
-            if row_idx == 1:
-                offset = key_width * 0.25
-            elif row_idx == 2:
-                offset = key_width * 0.5
-            elif row_idx == 3:
-                offset = key_width * 0.75
-            
+            offset = row_offsets[row_idx] if row_idx < len(row_offsets) else 0
             x_start = start_x + offset
+            mask = disabled_mask[row_idx] if row_idx < len(disabled_mask) else 0
             
-            # Проверяем отключённые клавиши для этого ряда
-            disabled_in_row = self.disabled_keys.get(f"row_{row_idx}", [])
-            
+            next_x = x_start
             for col_idx, char in enumerate(row):
+                x = next_x
+                w = key_span(char)
+                next_x += w + key_spacing
                 # Пропускаем отключённые клавиши
-                en_char = char
-                if self.current_display_layout == 'ru' and row_idx < len(self.english_layout):
-                    if col_idx < len(self.english_layout[row_idx]):
-                        en_char = self.english_layout[row_idx][col_idx]
-                
-                if en_char in disabled_in_row:
+                if mask & (1 << col_idx):
                     continue
                 
-                x = x_start + col_idx * (key_width + key_spacing)
                 y = start_y + display_row_idx * (key_height + key_spacing)
                 
-                is_pressed = False
-                press_alpha = 0.0
-                
-                # Прямая проверка символа
-                if char in self.pressed_keys:
-                    is_pressed = True
-                    press_alpha = self.pressed_keys[char][1]
-                
-                # Для русской раскладки: проверяем английский эквивалент
-                # (pynput может возвращать английские символы даже при русской раскладке)
-                elif self.current_display_layout == 'ru':
-                    en_equivalent = self.ru_to_en_map.get(char)
-                    if en_equivalent and en_equivalent in self.pressed_keys:
-                        is_pressed = True
-                        press_alpha = self.pressed_keys[en_equivalent][1]
+                shapes = {
+                    'body': points(x, y, w, h, radius),
+                    'body_pressed': points(x, y + depth / 2, w, h, radius),
+                }
+                if self.key_style == 'rounded':
+                    shapes['shadow'] = points(x + shadow_size, y + shadow_size, w, h, radius)
+                elif self.key_style == '3d':
+                    shapes['bottom'] = points(x, y + depth, w, h, radius)
+                    shapes['highlight'] = points(x + 2, y + 2, w - 4, h / 3, radius / 2)
+                elif self.key_style == 'glass':
+                    shapes['highlight'] = points(x + 3, y + 2, w - 6, h / 2.5, radius / 2)
+                    shapes['reflection'] = points(x + 3, y + h * 0.6, w - 6, h / 3, radius / 2)
                 
-                # Для английской раскладки: проверяем русский эквивалент
-                # (если пользователь нажимал при русской раскладке)
-                elif self.current_display_layout == 'en':
-                    ru_equivalent = self.en_to_ru_map.get(char)
-                    if ru_equivalent and ru_equivalent in self.pressed_keys:
-                        is_pressed = True
-                        press_alpha = self.pressed_keys[ru_equivalent][1]
-                
-                self._draw_key(x, y, key_width, key_height, char, press_alpha)
-    
-    def _draw_key(self, x, y, width, height, char, press_alpha):
-        """Рисуем одну клавишу с учётом стиля"""
-        is_pressed = press_alpha > 0.05
-        
-        if is_pressed:
-            bg_color = self.colors['key_pressed']
-            text_color = self.colors.get('key_pressed_text', '#000000')
-            border_color = self.colors.get('key_pressed_border', self.colors['key_pressed'])
-            bw = max(self.border_width, 3)
-        else:
-            bg_color = self.colors['key_bg']
-            text_color = self.colors['key_text']
-            border_color = self.colors['key_border']
-            bw = self.border_width
+                text_y = y + h / 2
+                keys.append({
+                    'row': row_idx,
+                    'col': col_idx,
+                    'char': char,
+                    'label': labels[(row_idx, col_idx)],
+                    'key_id': key_ids[(row_idx, col_idx)],
+                    'rect': (x, y, x + w, y + h),
+                    'shapes': shapes,
+                    'text': (x + w / 2, text_y),
+                    'text_pressed': (x + w / 2, text_y + 2 * self.scale) if self.key_style == '3d' else (x + w / 2, text_y),
+                    'text_shadow': (x + w / 2 + 1, text_y + 1),
+                })
         
-        bg_rgb = self._hex_to_rgb(bg_color)
-        border_rgb = self._hex_to_rgb(border_color)
-        shadow_rgb = self._hex_to_rgb(self.colors.get('key_shadow', '#20000000'))
-        highlight_rgb = self._hex_to_rgb(self.colors.get('key_highlight', '#40ffffff'))
+        return {'keys': keys, 'disabled_mask': disabled_mask}
+
+    def _build_scene(self):
+        """Создаёт элементы canvas для всех клавиш один раз"""
+        self.renderer.clear()
+        self._scene = []
+        self._scene_by_key = {}
+        self._scene_dirty = False
+        self._sprites_active = (self.render_backend == 'sprites' and not self.headless
+                                and _load_pil() and ImageTk is not None)
         
-        radius = self.border_radius * self.scale
-        shadow_size = self.shadow_size * self.scale
+        for geo in self._get_geometry()['keys']:
+            if self._sprites_active:
+                record = self._create_key_sprite(geo)
+            else:
+                record = self._create_key_items(geo)
+            self._apply_key_state(record, 0.0, (False, 0.0, 0))
+            self._scene.append(record)
+            self._scene_by_key[geo['key_id']] = record
         
-        # ===== Стиль: Flat =====
-        if self.key_style == 'flat':
-            self.canvas.create_rectangle(
-                x, y, x + width, y + height,
-                fill=bg_rgb if bg_rgb else '',
-                outline=border_rgb if border_rgb else border_color,
-                width=bw,
-                tags="key"
+        # Скорость набора в режиме тепловой карты
+        self._speed_item = None
+        self._speed_text = None
+        if self.display_mode == 'heatmap':
+            self._speed_item = self.renderer.text(
+                (self.width - 8, 3), '',
+                self._palette['normal']['text'],
+                ('Segoe UI', max(8, int(11 * self.scale)), 'bold'),
+                anchor='ne'
             )
+            self._update_speed_readout()
+
+    def _draw_keyboard(self, key_ids=None):
+        """Обновление клавиатуры: перенастраиваем только изменившиеся клавиши (или только key_ids)"""
+        if self._scene_dirty:
+            self._build_scene()
+        if key_ids is None:
+            records = self._scene
+        else:
+            records = [self._scene_by_key[k] for k in key_ids if k in self._scene_by_key]
+        
+        alphas = self._press_alpha
+        heat_levels = self.heatmap.levels if self.display_mode == 'heatmap' else None
+        glow_factor = 3 * self.scale * self.glow_intensity
+        sprite_levels = self.SPRITE_PRESS_LEVELS if self._sprites_active else 0
+        for record in records:
+            key_id = record['geo']['key_id']
+            press_alpha = alphas[key_id]
+            
+            # Визуальное состояние: нажата ли клавиша и сила свечения
+            glow = glow_factor * press_alpha if press_alpha > 0.3 and glow_factor > 0 else 0.0
+            if sprite_levels and glow:
+                # Спрайты заготовлены только для нескольких уровней яркости
+                glow = glow_factor * math.ceil(press_alpha * sprite_levels) / sprite_levels
+            state = (press_alpha > 0.05, glow, heat_levels[key_id] if heat_levels is not None else 0)
+            
+            if state != record['state']:
+                self._apply_key_state(record, press_alpha, state)
+        
+        if self._latency_pending and self._latency_job is None:
+            # Canvas перерисуется в idle-проходе Tk; наш idle-вызов встанет в очередь после него
+            self._latency_job = self.root.after_idle(self._stamp_latency)
+    
+    def _stamp_latency(self):
+        """Кадр с новыми нажатиями отрисован: записать задержку от хука клавиатуры"""
+        self._latency_job = None
+        now = time.perf_counter()
+        for hook_time in self._latency_pending:
+            self.latency.add((now - hook_time) * 1000)
+        self._latency_pending.clear()
+    
+    def _create_key_items(self, geo):
+        """Создаёт элементы одной клавиши с учётом стиля, возвращает запись клавиши"""
+        palette = self._palette
+        shadow_rgb = palette['shadow']
+        highlight_rgb = palette['highlight']
+        
+        radius = self.border_radius * self.scale
+        shapes = geo['shapes']
+        items = {}
         
         # ===== Стиль: Rounded =====
-        elif self.key_style == 'rounded':
+        if self.key_style == 'rounded':
             # Тень
-            if shadow_size > 0 and shadow_rgb and not is_pressed:
-                self._draw_rounded_rect(x + shadow_size, y + shadow_size, width, height, radius, shadow_rgb, '', 0)
+            if self.shadow_size > 0 and shadow_rgb:
+                items['shadow'] = self._draw_rounded_rect(shapes['shadow'], radius, shadow_rgb, '', 0)
             
-            self._draw_rounded_rect(x, y, width, height, radius, bg_rgb, border_rgb, bw)
+            items['body'] = self._draw_rounded_rect(shapes['body'], radius, '', '', 0)
         
         # ===== Стиль: 3D =====
         elif self.key_style == '3d':
-            depth = 4 * self.scale
+            # Нижняя часть (тень 3D)
+            items['bottom'] = self._draw_rounded_rect(shapes['bottom'], radius, palette['bottom_3d'], '', 0)
             
-            if not is_pressed:
-                # Нижняя часть (тень 3D)
-                darker = self._darken_color(bg_rgb, 0.6) if bg_rgb else '#333333'
-                self._draw_rounded_rect(x, y + depth, width, height, radius, darker, '', 0)
-                
-                # Верхняя часть
-                self._draw_rounded_rect(x, y, width, height, radius, bg_rgb, border_rgb, bw)
-                
-                # Подсветка сверху
-                if highlight_rgb:
-                    self._draw_rounded_rect(x + 2, y + 2, width - 4, height / 3, radius / 2, highlight_rgb, '', 0)
-            else:
-                # Нажатая - без 3D эффекта, смещённая вниз
-                self._draw_rounded_rect(x, y + depth / 2, width, height, radius, bg_rgb, border_rgb, bw)
+            # Верхняя часть
+            items['body'] = self._draw_rounded_rect(shapes['body'], radius, '', '', 0)
+            
+            # Подсветка сверху
+            if highlight_rgb:
+                items['highlight'] = self._draw_rounded_rect(shapes['highlight'], radius / 2, highlight_rgb, '', 0)
         
         # ===== Стиль: Glass =====
         elif self.key_style == 'glass':
             # Основа
-            self._draw_rounded_rect(x, y, width, height, radius, bg_rgb, border_rgb, bw)
+            items['body'] = self._draw_rounded_rect(shapes['body'], radius, '', '', 0)
             
             # Верхний блик
-            if highlight_rgb and not is_pressed:
-                self._draw_rounded_rect(x + 3, y + 2, width - 6, height / 2.5, radius / 2, highlight_rgb, '', 0)
+            if highlight_rgb:
+                items['highlight'] = self._draw_rounded_rect(shapes['highlight'], radius / 2, highlight_rgb, '', 0)
             
             # Отражение снизу
-            if not is_pressed:
-                reflection = self._hex_to_rgb('#10ffffff')
-                if reflection:
-                    self._draw_rounded_rect(x + 3, y + height * 0.6, width - 6, height / 3, radius / 2, reflection, '', 0)
+            if palette['reflection']:
+                items['reflection'] = self._draw_rounded_rect(shapes['reflection'], radius / 2, palette['reflection'], '', 0)
         
+        # ===== Стиль: Flat (и fallback) =====
         else:
-            # Fallback
-            self.canvas.create_rectangle(
-                x, y, x + width, y + height,
-                fill=bg_rgb if bg_rgb else '',
-                outline=border_rgb if border_rgb else border_color,
-                width=bw,
-                tags="key"
-            )
-        
-        # Эффект свечения при нажатии
-        if press_alpha > 0.3 and self.glow_intensity > 0:
-            glow = 3 * self.scale * press_alpha * self.glow_intensity
-            for i in range(int(glow)):
-                alpha = (1 - i / glow) * 0.3
-                glow_color = self._apply_alpha(self.colors['key_pressed'], alpha)
-                self.canvas.create_rectangle(
-                    x - i, y - i,
-                    x + width + i, y + height + i,
-                    fill='',
-                    outline=glow_color,
-                    width=1,
-                    tags="key"
-                )
+            items['body'] = self.renderer.rect(geo['rect'])
         
         # Текст
         font_size = max(12, int(16 * self.scale))
-        text_y = y + height / 2
-        
-        if self.key_style == '3d' and not is_pressed:
-            text_y = y + height / 2
-        elif self.key_style == '3d' and is_pressed:
-            text_y = y + height / 2 + 2 * self.scale
         
         # Тень текста
-        if not is_pressed and self.shadow_size > 0:
-            self.canvas.create_text(
-                x + width / 2 + 1, text_y + 1,
-                text=char.upper(),
-                fill='#202020',
-                font=('Arial', font_size, 'bold'),
-                tags="key"
-            )
+        if self.shadow_size > 0:
+            items['text_shadow'] = self.renderer.text(
+                geo['text_shadow'], geo['label'], '#202020', ('Arial', font_size, 'bold'))
         
         # Основной текст
-        self.canvas.create_text(
-            x + width / 2, text_y,
-            text=char.upper(),
-            fill=text_color,
-            font=('Arial', font_size, 'bold'),
-            tags="key"
-        )
+        items['text'] = self.renderer.text(geo['text'], geo['label'], '', ('Arial', font_size, 'bold'))
+        
+        return {
+            'geo': geo,
+            'items': items,
+            'glow': [],
+            'glow_colors': [],
+            'state': None,
+        }
     
-    def _draw_rounded_rect(self, x, y, width, height, radius, fill, outline, outline_width):
-        """Рисует скруглённый прямоугольник"""
-        if radius <= 0:
-            self.canvas.create_rectangle(
-                x, y, x + width, y + height,
-                fill=fill if fill else '',
-                outline=outline if outline else '',
-                width=outline_width,
-                tags="key"
-            )
+    def _apply_key_state(self, record, press_alpha, state):
+        """Перенастраивает уже созданные элементы клавиши под новое состояние"""
+        is_pressed, glow, heat = state
+        items = record['items']
+        if 'sprite' in items:
+            self.renderer.configure(items['sprite'], image=self._get_key_sprite(record['geo'], is_pressed, glow, heat))
+            record['state'] = state
             return
+        geo = record['geo']
+        
+        colors = self._palette['pressed'] if is_pressed else self._palette['heat'][heat]
+        bw = max(self.border_width, 3) if is_pressed else self.border_width
+        if self.key_style in ('rounded', '3d', 'glass'):
+            outline = colors['outline_shape']
+        else:
+            outline = colors['outline_flat']
+        
+        self.renderer.configure(items['body'], fill=colors['fill'], outline=outline, width=bw)
+        
+        # Декоративные слои видны только у отпущенной клавиши
+        decor_state = 'hidden' if is_pressed else 'normal'
+        for name in ('shadow', 'bottom', 'highlight', 'reflection', 'text_shadow'):
+            if name in items:
+                self.renderer.configure(items[name], state=decor_state)
+        
+        if self.key_style == '3d':
+            # Нажатая - без 3D эффекта, смещённая вниз
+            shapes = geo['shapes']
+            self.renderer.move(items['body'], shapes['body_pressed'] if is_pressed else shapes['body'])
+            self.renderer.move(items['text'], geo['text_pressed'] if is_pressed else geo['text'])
+        self.renderer.configure(items['text'], fill=colors['text'])
+        
+        # Свечение: пул колец клавиши только растёт, дальше кольца перекрашиваются и прячутся
+        rings = record['glow']
+        ring_colors = record['glow_colors']  # цвет показанного кольца, '' — спрятано
+        ring_count = int(glow)
+        glow_steps = self._palette['glow']
+        for i in range(ring_count):
+            alpha = (1 - i / glow) * 0.3
+            glow_color = glow_steps[int(alpha * self.ALPHA_LEVELS + 0.5)]
+            if i == len(rings):
+                x1, y1, x2, y2 = geo['rect']
+                below = items.get('text_shadow', items['text'])
+                rings.append(self.renderer.glow((x1 - i, y1 - i, x2 + i, y2 + i), glow_color, below))
+                ring_colors.append(glow_color)
+            elif ring_colors[i] != glow_color:
+                self.renderer.configure(rings[i], outline=glow_color, state='normal')
+                ring_colors[i] = glow_color
+        for i in range(ring_count, len(rings)):
+            if ring_colors[i]:
+                self.renderer.configure(rings[i], state='hidden')
+                ring_colors[i] = ''
+        
+        record['state'] = state
+    
+    def _create_key_sprite(self, geo):
+        """Клавиша как один image-элемент из атласа спрайтов"""
+        x1, y1, x2, y2 = geo['rect']
+        item = self.renderer.image(((x1 + x2) / 2, (y1 + y2) / 2))
+        return {
+            'geo': geo,
+            'items': {'sprite': item},
+            'glow': [],
+            'glow_colors': [],
+            'state': None,
+        }
+    
+    def _sprite_font(self, size):
+        """Шрифт Pillow для подписей спрайтов (с кэшем по размеру)"""
+        font = self._sprite_fonts.get(size)
+        if font is None:
+            for name in ('arialbd.ttf', 'Arial Bold.ttf', 'DejaVuSans-Bold.ttf'):
+                try:
+                    font = ImageFont.truetype(name, size)
+                    break
+                except Exception:
+                    continue
+            if font is None:
+                try:
+                    font = ImageFont.load_default(size)
+                except Exception:
+                    font = ImageFont.load_default()
+            self._sprite_fonts[size] = font
+        return font
+    
+    def _get_key_sprite(self, geo, is_pressed, glow, heat=0):
+        """Спрайт клавиши из атласа; рисуется при первом запросе"""
+        atlas_key = (self._palette['key'], geo['label'], is_pressed, glow, heat)
+        image = self._sprite_atlas.get(atlas_key)
+        if image is None:
+            image = ImageTk.PhotoImage(self._render_key_sprite(geo, is_pressed, glow, heat), master=self.root)
+            self._sprite_atlas[atlas_key] = image
+        return image
+    
+    def _render_key_sprite(self, geo, is_pressed, glow, heat=0, palette=None):
+        """Рисует клавишу средствами Pillow со сглаживанием (повторяет слои canvas); без Tk — можно из фонового потока"""
+        ss = self.SPRITE_SUPERSAMPLE
+        x1, y1, x2, y2 = geo['rect']
+        width, height = x2 - x1, y2 - y1
+        # Поле вокруг клавиши под тень, 3D-основание и свечение
+        margin = int(math.ceil(max(self.shadow_size * self.scale, 4 * self.scale, 3 * self.scale * self.glow_intensity))) + 2
+        size = (int(math.ceil(width)) + 2 * margin, int(math.ceil(height)) + 2 * margin)
+        img = Image.new('RGBA', (size[0] * ss, size[1] * ss), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        
+        def box(dx, dy, w, h):
+            return [(margin + dx) * ss, (margin + dy) * ss, (margin + dx + w) * ss, (margin + dy + h) * ss]
+        
+        def shape(dx, dy, w, h, radius, fill, outline='', outline_width=0):
+            r = max(0, min(radius, w / 2, h / 2)) * ss
+            draw.rounded_rectangle(
+                box(dx, dy, w, h), radius=r,
+                fill=fill or None,
+                outline=outline or None,
+                width=int(round(outline_width * ss)) if outline else 0
+            )
+        
+        palette = palette or self._palette
+        colors = palette['pressed'] if is_pressed else palette['heat'][heat]
+        bw = max(self.border_width, 3) if is_pressed else self.border_width
+        radius = self.border_radius * self.scale
+        shadow_size = self.shadow_size * self.scale
+        depth = 4 * self.scale
+        
+        if self.key_style == 'rounded':
+            if shadow_size > 0 and palette['shadow'] and not is_pressed:
+                shape(shadow_size, shadow_size, width, height, radius, palette['shadow'])
+            shape(0, 0, width, height, radius, colors['fill'], colors['outline_shape'], bw)
+        elif self.key_style == '3d':
+            if not is_pressed:
+                shape(0, depth, width, height, radius, palette['bottom_3d'])
+                shape(0, 0, width, height, radius, colors['fill'], colors['outline_shape'], bw)
+                if palette['highlight']:
+                    shape(2, 2, width - 4, height / 3, radius / 2, palette['highlight'])
+            else:
+                shape(0, depth / 2, width, height, radius, colors['fill'], colors['outline_shape'], bw)
+        elif self.key_style == 'glass':
+            shape(0, 0, width, height, radius, colors['fill'], colors['outline_shape'], bw)
+            if not is_pressed:
+                if palette['highlight']:
+                    shape(3, 2, width - 6, height / 2.5, radius / 2, palette['highlight'])
+                if palette['reflection']:
+                    shape(3, height * 0.6, width - 6, height / 3, radius / 2, palette['reflection'])
+        else:
+            shape(0, 0, width, height, 0, colors['fill'], colors['outline_shape'], bw)
+        
+        # Кольца свечения
+        glow_steps = palette['glow']
+        for i in range(int(glow)):
+            alpha = (1 - i / glow) * 0.3
+            draw.rectangle(box(-i, -i, width + 2 * i, height + 2 * i),
+                           outline=glow_steps[int(alpha * self.ALPHA_LEVELS + 0.5)], width=ss)
+        
+        # Текст (размер шрифта Tk в пунктах -> пиксели)
+        font = self._sprite_font(int(max(12, int(16 * self.scale)) * 4 / 3 * ss))
+        cx = (margin + width / 2) * ss
+        cy = (margin + height / 2) * ss
+        if self.key_style == '3d' and is_pressed:
+            cy += 2 * self.scale * ss
+        if not is_pressed and self.shadow_size > 0:
+            draw.text((cx + ss, cy + ss), geo['label'], fill='#202020', font=font, anchor='mm')
+        draw.text((cx, cy), geo['label'], fill=colors['text'], font=font, anchor='mm')
+        
+        return img.resize(size, Image.LANCZOS)
+    
+    def _rounded_rect_points(self, x, y, width, height, radius):
+        """Координаты скруглённого прямоугольника (или обычного при radius <= 0)"""
+        if radius <= 0:
+            return (x, y, x + width, y + height)
         
         # Ограничиваем радиус
         radius = min(radius, width / 2, height / 2)
         
-        points = [
+        return (
             x + radius, y,
             x + width - radius, y,
             x + width, y,
@@ -1284,17 +3354,90 @@ class KeyboardOverlay:
             x, y + radius,
             x, y,
             x + radius, y,
-        ]
-        
-        self.canvas.create_polygon(
-            points,
-            fill=fill if fill else '',
-            outline=outline if outline else '',
-            width=outline_width,
-            smooth=True,
-            tags="key"
         )
     
+    def _draw_rounded_rect(self, points, radius, fill, outline, outline_width):
+        """Рисует скруглённый прямоугольник по готовым точкам, возвращает id элемента"""
+        if radius <= 0:
+            return self.renderer.rect(points, fill or '', outline or '', outline_width)
+        return self.renderer.rounded_rect(points, fill or '', outline or '', outline_width)
+    
+    def _compile_palette(self, colors, key='custom'):
+        """Разбирает цвета (из self.colors или темы) один раз в готовые RGB-строки"""
+        to_rgb = self._hex_to_rgb
+        
+        def state_colors(bg, border, text):
+            border_rgb = to_rgb(border)
+            return {
+                'fill': to_rgb(bg) or '',
+                'outline_shape': border_rgb or '',
+                'outline_flat': border_rgb or border,
+                'text': text,
+            }
+        
+        key_bg = colors.get('key_bg', '#30202030')
+        key_pressed = colors.get('key_pressed', '#00d4ff')
+        bg_rgb = to_rgb(key_bg)
+        normal = state_colors(key_bg, colors.get('key_border', '#60ffffff'), colors.get('key_text', '#ffffff'))
+        
+        # Тепловая карта: фон клавиши от обычного к цвету нажатия, уровень 0 — обычная клавиша
+        heat = [normal]
+        for level in range(1, KeyHeatmap.LEVELS + 1):
+            tint = dict(normal)
+            tint['fill'] = self._mix_colors(bg_rgb or '#101010', to_rgb(key_pressed) or '#00d4ff',
+                                            0.15 + 0.7 * level / KeyHeatmap.LEVELS)
+            heat.append(tint)
+        
+        return self._freeze({
+            'key': key,  # тема (или 'custom') — для атласа спрайтов и кэша рамп
+            'normal': normal,
+            'heat': heat,
+            'pressed': state_colors(
+                key_pressed,
+                colors.get('key_pressed_border', key_pressed),
+                colors.get('key_pressed_text', '#000000'),
+            ),
+            'shadow': to_rgb(colors.get('key_shadow', '#20000000')),
+            'highlight': to_rgb(colors.get('key_highlight', '#40ffffff')),
+            'bottom_3d': self._darken_color(bg_rgb, 0.6) if bg_rgb else '#333333',
+            'reflection': to_rgb('#10ffffff'),
+            # Градиент свечения: цвет нажатия для каждого уровня альфы
+            'glow': [self._alpha_color(key_pressed, level / self.ALPHA_LEVELS)
+                     for level in range(self.ALPHA_LEVELS + 1)],
+        })
+    
+    @staticmethod
+    def _freeze(value):
+        """Неизменяемая копия палитры: словари — MappingProxyType, списки — кортежи"""
+        if isinstance(value, dict):
+            return MappingProxyType({k: KeyboardOverlay._freeze(v) for k, v in value.items()})
+        if isinstance(value, (list, tuple)):
+            return tuple(KeyboardOverlay._freeze(v) for v in value)
+        return value
+    
+    def _alpha_color(self, hex_color, alpha):
+        """_apply_alpha с ограниченным кэшем по квантованной альфе"""
+        level = int(alpha * self.ALPHA_LEVELS + 0.5)
+        key = (hex_color, level)
+        color = self._alpha_color_cache.get(key)
+        if color is None:
+            if len(self._alpha_color_cache) >= 1024:
+                self._alpha_color_cache.clear()
+            color = self._apply_alpha(hex_color, level / self.ALPHA_LEVELS)
+            self._alpha_color_cache[key] = color
+        return color
+    
+    def _mix_colors(self, color_a, color_b, t):
+        """Смешивает два цвета #rrggbb: t=0 — первый, t=1 — второй"""
+        a = color_a.lstrip('#')
+        b = color_b.lstrip('#')
+        channels = []
+        for i in (0, 2, 4):
+            ca = int(a[i:i + 2], 16)
+            cb = int(b[i:i + 2], 16)
+            channels.append(int(ca + (cb - ca) * t))
+        return '#{:02x}{:02x}{:02x}'.format(*channels)
+    
     def _darken_color(self, hex_color, factor):
         """Затемняет цвет"""
         if not hex_color:
@@ -1352,14 +3495,94 @@ class KeyboardOverlay:
         
         return None
     
+    def _set_display_mode(self, mode, window=None):
+        """Обычный режим или тепловая карта (поток Tk)"""
+        if window is not None and float(window) != self.heatmap.window:
+            self.heatmap_window = float(window)
+            self.heatmap.window = max(1.0, self.heatmap_window)
+        self.display_mode = mode
+        if self._heatmap_job is not None:
+            self.root.after_cancel(self._heatmap_job)
+            self._heatmap_job = None
+        if mode == 'heatmap':
+            self._heatmap_tick()
+        self._invalidate_scene()
+        self._request_animation()
+    
+    def _heatmap_tick(self):
+        """Раз в секунду: уровни тепловой карты и скорость набора; кадр — только если что-то изменилось"""
+        self._heatmap_job = self.root.after(1000, self._heatmap_tick)
+        if self._overlay_hidden:
+            return
+        now = time.monotonic()
+        levels_changed = self.heatmap.update_levels(now)
+        self._update_speed_readout(now)
+        if levels_changed:
+            self._request_animation()
+    
+    def _update_speed_readout(self, now=None):
+        """Текст «KPM / WPM» (WPM — из расчёта 5 нажатий на слово)"""
+        if self._speed_item is None:
+            return
+        kpm = self.heatmap.kpm(time.monotonic() if now is None else now)
+        text = f"{kpm} KPM · {kpm / 5:.0f} WPM"
+        if text != self._speed_text:
+            self._speed_text = text
+            self.renderer.configure(self._speed_item, text=text)
+    
+    def _request_animation(self):
+        """Запланировать ближайший кадр (только из потока Tk)"""
+        self._wake_on_input = False
+        if self._overlay_hidden:
+            return
+        if self._animation_job is not None:
+            if not self._animation_job_is_wake:
+                return
+            # Отменяем отложенное пробуждение (ожидание простоя) — кадр нужен сейчас
+            try:
+                self.root.after_cancel(self._animation_job)
+            except Exception:
+                pass
+        self._schedule_frame(0)
+    
+    def _schedule_frame(self, delay_ms, is_wake=False):
+        """Поставить следующий вызов _animate через delay_ms"""
+        self._animation_job_is_wake = is_wake
+        self._frame_due = time.perf_counter() + delay_ms / 1000
+        self._animation_job = self.root.after(delay_ms, self._animate)
+        if not is_wake and self.immediate_redraw and self._input_poll_job is None:
+            self._input_poll_job = self.root.after(self.INPUT_POLL_MS, self._poll_input)
+    
+    def _is_animating(self, time_since_activity):
+        """Есть ли незавершённая анимация (затухание клавиш, альфа окна, уход в простой)"""
+        if self._active_keys or self._scene_dirty or self._theme_fade is not None:
+            return True
+        if abs(self.target_alpha - self.current_alpha) > 0.002:
+            return True
+        idle_end = self.idle_timeout + self.fade_duration
+        return self.idle_timeout < time_since_activity < idle_end
+    
     def _animate(self):
         """Анимация"""
-        current_time = time.time()
+        self._animation_job = None
+        self._animation_job_is_wake = False
+        if self._overlay_hidden:
+            self.pacer.sleep()
+            return
+        
+        frame_start = time.perf_counter()
+        self.pacer.begin(frame_start)
+        prof = self.profiler
+        if prof is not None:
+            # Опоздание относительно запланированного времени — работа самого Tk
+            if self._frame_due is not None:
+                prof.add('tk_idle', max(0.0, (frame_start - self._frame_due) * 1000))
         
-        # Обновляем раскладку для отображения (без очистки pressed_keys)
-        new_layout = self._detect_windows_layout()
-        if new_layout != self.current_display_layout:
-            self.current_display_layout = new_layout
+        self._drain_input_events()
+        current_time = time.monotonic()
+        if prof is not None:
+            t_input = time.perf_counter()
+            prof.add('input', (t_input - frame_start) * 1000)
         
         time_since_activity = current_time - self.last_activity_time
         if time_since_activity > self.idle_timeout:
@@ -1369,32 +3592,178 @@ class KeyboardOverlay:
             self.target_alpha = self.max_alpha
         
         alpha_diff = self.target_alpha - self.current_alpha
-        self.current_alpha += alpha_diff * 0.1
+        self.current_alpha += alpha_diff * self._alpha_step
+        if abs(self.target_alpha - self.current_alpha) <= 0.002:
+            self.current_alpha = self.target_alpha
         
-        if platform.system() == 'Windows':
-            self.root.attributes('-alpha', self.current_alpha)
-        
-        keys_to_remove = []
-        for key_name, (press_time, alpha) in list(self.pressed_keys.items()):
-            time_since = current_time - press_time
-            if time_since > self.key_fade_duration:
-                keys_to_remove.append(key_name)
-            else:
-                new_alpha = max(0.0, 1.0 - (time_since / self.key_fade_duration))
-                self.pressed_keys[key_name] = (press_time, new_alpha)
+        self.window_state.set_alpha(self.current_alpha)
+        # Накопленное с прошлого кадра (альфа, перетаскивание) — в оконный менеджер один раз за кадр
+        self.window_state.flush()
+        if prof is not None:
+            t_alpha = time.perf_counter()
+            prof.add('alpha', (t_alpha - t_input) * 1000)
         
-        for key in keys_to_remove:
-            del self.pressed_keys[key]
+        # Затухание одним проходом по активным клавишам, без временных объектов на клавишу
+        if self._active_keys:
+            press_times = self._press_times
+            press_alpha = self._press_alpha
+            lut = self._fade_lut
+            steps = len(lut)
+            steps_per_second = steps / self.key_fade_duration
+            still_active = []
+            for key_id in self._active_keys:
+                step = int((current_time - press_times[key_id]) * steps_per_second)
+                if step < steps:
+                    press_alpha[key_id] = lut[step] if step > 0 else 1.0
+                    still_active.append(key_id)
+                else:
+                    press_alpha[key_id] = 0.0
+            self._active_keys = still_active
+        if prof is not None:
+            t_fade = time.perf_counter()
+            prof.add('fade', (t_fade - t_alpha) * 1000)
         
+        if self._theme_fade is not None:
+            self._step_theme_fade(current_time)
         self._draw_keyboard()
+        if prof is not None:
+            t_draw = time.perf_counter()
+            prof.add('draw', (t_draw - t_fade) * 1000)
+            prof.end_frame((t_draw - frame_start) * 1000)
         
-        self.root.after(16, self._animate)
+        if self._is_animating(time_since_activity):
+            self._schedule_frame(self.pacer.end(time.perf_counter()))
+            return
+        
+        # Всё в покое: засыпаем до следующего нажатия
+        self._wake_on_input = True
+        if not self._input_events.empty():
+            # Нажатие пришло, пока мы решали уснуть
+            self._wake_on_input = False
+            self._schedule_frame(self.pacer.end(time.perf_counter()))
+            return
+        self.pacer.sleep()
+        if time_since_activity <= self.idle_timeout:
+            # Проснёмся один раз, когда начнётся уход в простой
+            delay_ms = int((self.idle_timeout - time_since_activity) * 1000) + 1
+            self._schedule_frame(delay_ms, is_wake=True)
     
     def run(self):
         """Запуск"""
         self.root.mainloop()
 
 
-if __name__ == "__main__":
-    app = KeyboardOverlay()
+def profile_startup(config_path, budget_ms):
+    """Холодный старт без трея: время фаз до первого кадра; код выхода 1 при превышении бюджета"""
+    overlay = KeyboardOverlay(config_path=config_path, start_tray=False)
+    overlay.root.update()
+    overlay._mark_startup('first_paint')
+    if overlay.listener_thread is not None:
+        overlay.listener_thread.join(timeout=2.0)
+
+    critical = [(name, ms) for name, ms in overlay.startup_phases if not name.endswith('(фон)')]
+    background = [(name, ms) for name, ms in overlay.startup_phases if name.endswith('(фон)')]
+    total = sum(ms for _, ms in critical)
+    for name, ms in critical + background:
+        print(f"{name:24} {ms:8.1f} мс")
+    print(f"{'итого до первого кадра':24} {total:8.1f} мс (бюджет {budget_ms:.0f} мс)")
+    overlay._log(f"Startup profile: {total:.1f} ms, " + ", ".join(f"{n}={ms:.1f}" for n, ms in critical))
+
+    # Замер запуска ничего не меняет в настройках — config.json не перезаписываем
+    overlay._quit(save=False)
+    return 0 if total <= budget_ms else 1
+
+
+def replay_session(config_path, log_path, speed=1.0):
+    """Проигрывает лог нажатий в оверлее и печатает время кадров.
+
+    speed > 0 — с исходными паузами (ускоренными в speed раз) через цикл Tk,
+    speed == 0 — без пауз: кадр сразу после каждого события.
+    """
+    overlay = KeyboardOverlay(config_path=config_path, start_listener=False, start_tray=False)
+    try:
+        replay = KeystrokeReplay(log_path, overlay.layouts, len(overlay._key_ids))
+    except (OSError, ValueError):
+        overlay._quit(save=False)
+        raise
+    overlay._set_profiling(True)
+    events = replay.events()
+
+    def feed(press_time, char, key_id, layout):
+        if layout is not None:
+            overlay._apply_display_layout(layout)
+        overlay._input_events.put((press_time, key_id, char, time.perf_counter()))
+
+    if speed <= 0:
+        for _, char, key_id, layout in events:
+            feed(time.monotonic(), char, key_id, layout)
+            if overlay._animation_job is not None:
+                overlay.root.after_cancel(overlay._animation_job)
+                overlay._animation_job = None
+            overlay._animate()
+            overlay.root.update_idletasks()
+    else:
+        start = time.perf_counter()
+        first = [None]
+
+        def step():
+            for press_time, char, key_id, layout in events:
+                if first[0] is None:
+                    first[0] = press_time
+                due_ms = (press_time - first[0]) / speed * 1000 - (time.perf_counter() - start) * 1000
+                if due_ms > 1:
+                    overlay.root.after(int(due_ms), lambda: (feed(time.monotonic(), char, key_id, layout),
+                                                             overlay._request_animation(), step()))
+                    return
+                feed(time.monotonic(), char, key_id, layout)
+                overlay._request_animation()
+            # Даём клавишам догаснуть и выходим из цикла; отчёт и закрытие — ниже
+            overlay.root.after(int(overlay.key_fade_duration * 1000) + 100, overlay.root.quit)
+
+        overlay.root.after(0, step)
+        overlay.root.mainloop()
+
+    print(f"{log_path}: {len(replay)} событий")
+    print(overlay.latency.report_line())
+    for line in overlay.profiler.report_lines():
+        print(line)
+    overlay._log_profile()
+    replay.close()
+    # Проигрывание — не пользовательский сеанс: config.json не перезаписываем
+    overlay._quit(save=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyboard Overlay")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Замерить фазы запуска, вывести отчёт и выйти")
+    parser.add_argument('--startup-budget-ms', type=float, default=500.0,
+                        help="Бюджет холодного старта для --profile-startup")
+    parser.add_argument('--record', metavar='FILE', help="Записывать нажатия в бинарный лог")
+    parser.add_argument('--replay', metavar='FILE', help="Проиграть лог нажатий и выйти")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="Скорость проигрывания; 0 — без пауз, как можно быстрее")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        sys.exit(profile_startup(args.config, args.startup_budget_ms))
+    if args.replay:
+        try:
+            replay_session(args.config, args.replay, args.replay_speed)
+        except (OSError, ValueError) as e:
+            sys.exit(f"--replay: {e}")
+        return
+
+    app = KeyboardOverlay(config_path=args.config)
+    if args.record:
+        try:
+            app.start_recording(args.record)
+        except (OSError, ValueError) as e:
+            app._quit(save=False)
+            sys.exit(f"--record: {e}")
     app.run()
+
+
+if __name__ == "__main__":
+    main()
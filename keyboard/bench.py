@@ -0,0 +1,176 @@
+"""Микро-бенчмарк отрисовки оверлея.
+
+Создаёт KeyboardOverlay без pynput listener и трея, подаёт синтетические
+нажатия и замеряет стоимость кадра для каждого стиля клавиш.
+
+На Linux без экрана запускать через Xvfb:
+    xvfb-run python bench.py
+
+Либо без Tk вообще (--headless): отрисовка идёт в RecordingRenderer, замеряется
+только Python-часть кадра, плюс печатается число примитивов сцены по видам
+и число перенастроек (configure/move) за кадр:
+    python bench.py --headless --frames 5000
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from app import KeyboardOverlay
+
+STYLES = ['flat', 'rounded', '3d', 'glass']
+
+
+def make_overlay(style, scale, config_dir, headless=False):
+    """Оверлей с отдельным временным config.json (рабочий конфиг не трогаем)"""
+    config_path = os.path.join(config_dir, f'bench_{style}_{scale}.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump({'key_style': style, 'scale': scale}, f)
+    overlay = KeyboardOverlay(config_path=config_path, start_listener=False, start_tray=False, headless=headless)
+    # Собственный цикл анимации не нужен — кадры вызываем вручную
+    if overlay._animation_job is not None:
+        overlay.root.after_cancel(overlay._animation_job)
+        overlay._animation_job = None
+    overlay.root.update()
+    return overlay
+
+
+def close_overlay(overlay):
+    try:
+        overlay.layout_watcher.stop()
+        overlay.file_watcher.stop()
+        overlay.root.destroy()
+    except Exception:
+        pass
+
+
+def synthetic_pressed(overlay, pressed_count, frame, now):
+    """Нажатые клавиши с разной фазой затухания, чтобы состояние менялось каждый кадр"""
+    fade = overlay.key_fade_duration
+    press_times, press_alpha = overlay._press_times, overlay._press_alpha
+    active = []
+    for key_id in range(len(press_alpha)):
+        alpha = 1.0 - ((frame + key_id * 7) % 48) / 48.0 if key_id < pressed_count else 0.0
+        press_times[key_id] = now - (1.0 - alpha) * fade
+        press_alpha[key_id] = alpha
+        if alpha > 0.0:
+            active.append(key_id)
+    overlay._active_keys = active
+
+
+def items_created(renderer, fn):
+    """Выполняет fn и возвращает число созданных за это время элементов"""
+    before = renderer.created
+    fn()
+    return renderer.created - before
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def bench_case(overlay, pressed_count, frames):
+    """Замер одного сочетания стиль/масштаб/число нажатых клавиш"""
+    renderer = overlay.renderer
+    overlay._draw_keyboard()  # сцена строится вне замера
+    overlay.root.update_idletasks()
+    recording = hasattr(renderer, 'reset_counts')
+    if recording:
+        renderer.reset_counts()
+
+    draw_ms, animate_ms, tk_ms, created = [], [], [], []
+    for frame in range(frames):
+        synthetic_pressed(overlay, pressed_count, frame, time.monotonic())
+
+        start = time.perf_counter()
+        created.append(items_created(renderer, overlay._draw_keyboard))
+        draw_ms.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        overlay.root.update_idletasks()
+        tk_ms.append((time.perf_counter() - start) * 1000)
+
+        synthetic_pressed(overlay, pressed_count, frame, time.monotonic())
+        start = time.perf_counter()
+        overlay._animate()
+        animate_ms.append((time.perf_counter() - start) * 1000)
+        if overlay._animation_job is not None:
+            overlay.root.after_cancel(overlay._animation_job)
+            overlay._animation_job = None
+    # Перенастройки примитивов за кадр (кадр здесь — _draw_keyboard и _animate)
+    counts = dict(renderer.counts) if recording else {}
+
+    # Аллокации — отдельным проходом, tracemalloc заметно замедляет кадр
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    for frame in range(frames):
+        synthetic_pressed(overlay, pressed_count, frame, time.monotonic())
+        overlay._draw_keyboard()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'draw_p50_ms': statistics.median(draw_ms),
+        'draw_p95_ms': percentile(draw_ms, 0.95),
+        'animate_p50_ms': statistics.median(animate_ms),
+        'tk_p50_ms': statistics.median(tk_ms),
+        'items_per_frame': statistics.mean(created),
+        'peak_alloc_kb': (peak - base) / 1024,
+        'configure_per_frame': counts.get('configure', 0) / frames if recording else None,
+        'move_per_frame': counts.get('move', 0) / frames if recording else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк отрисовки Keyboard Overlay")
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--styles', nargs='+', default=STYLES, choices=STYLES)
+    parser.add_argument('--scales', nargs='+', type=float, default=[0.5, 1.0])
+    parser.add_argument('--pressed', nargs='+', type=int, default=[0, 1, 5, 20])
+    parser.add_argument('--json', help="Сохранить результаты в JSON-файл")
+    parser.add_argument('--headless', action='store_true',
+                        help="Без Tk: RecordingRenderer, только Python-часть кадра")
+    args = parser.parse_args()
+
+    results = []
+    header = f"{'style':8} {'scale':>5} {'keys':>4} | {'draw p50':>9} {'p95':>7} {'animate':>8} {'tk':>7} | {'items/fr':>8} {'alloc KB':>9}"
+    if args.headless:
+        header += f" | {'cfg/fr':>7} {'move/fr':>7}"
+    print(header)
+    print('-' * len(header))
+    with tempfile.TemporaryDirectory() as config_dir:
+        for style in args.styles:
+            for scale in args.scales:
+                overlay = make_overlay(style, scale, config_dir, args.headless)
+                try:
+                    if args.headless:
+                        overlay._draw_keyboard()
+                        scene = overlay.renderer.kinds()
+                        results.append({'style': style, 'scale': scale, 'scene_primitives': scene})
+                        print(f"{style:8} {scale:5.2f} scene: "
+                              + ', '.join(f"{kind}={n}" for kind, n in sorted(scene.items())))
+                    for pressed_count in args.pressed:
+                        r = bench_case(overlay, pressed_count, args.frames)
+                        r.update({'style': style, 'scale': scale, 'pressed': pressed_count})
+                        results.append(r)
+                        line = (f"{style:8} {scale:5.2f} {pressed_count:4d} | "
+                                f"{r['draw_p50_ms']:7.3f}ms {r['draw_p95_ms']:5.3f}ms {r['animate_p50_ms']:6.3f}ms "
+                                f"{r['tk_p50_ms']:5.3f}ms | {r['items_per_frame']:8.1f} {r['peak_alloc_kb']:9.1f}")
+                        if args.headless:
+                            line += f" | {r['configure_per_frame']:7.1f} {r['move_per_frame']:7.1f}"
+                        print(line)
+                finally:
+                    close_overlay(overlay)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()